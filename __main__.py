@@ -2,7 +2,7 @@ import re
 import logging
 
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import importer
 import exporter
@@ -15,7 +15,7 @@ def get_ext_str(raw_ad, ext):
     ext_str = ext
 
     if raw_ad[ext]:
-        ext_str = '%s (%s)' % (ext_str, ', '.join(raw_ad[ext_str]))
+        ext_str = '%s (%s)' % (ext_str, ', '.join(sorted(raw_ad[ext_str])))
 
     return ext_str
 
@@ -38,9 +38,6 @@ def main():
         log.critical('Не удалось загрузить список сотрудников из AD')
         exit()
 
-    at_inc_list = importer.get_at_inc_list()  # Импортируем список гор. входящих номеров из БД Астериска
-    at_out_list = importer.get_at_out_list()  # Испортируем список гор. исходящих номеров из БД Астериска
-
     re_exp_date = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
 
     raw_ad = defaultdict(set)
@@ -59,24 +56,96 @@ def main():
             for i in itn:
                 raw_ad[i].add(str(x.cn))
 
+    # Источник звонков: подробный лог Астериска (log), таблица cdr (cdr) или оба со сверкой (both)
+    call_source = utils.get_options('main', 'call_source', True, default='log')
+
+    if call_source not in ('log', 'cdr', 'both'):
+        log.critical('Неизвестный источник звонков: %s' % call_source)
+        exit()
+
+    # Дополнительные отчёты по календарным окнам: day, week или month, строятся за тот же проход по логу
+    report_windows = utils.get_options('main', 'report_windows', True, default='')
+
+    if report_windows and call_source == 'cdr':
+        log.warning('Отчёты по окнам строятся только по подробному логу')
+
+    # Секции конфигурации АТС, у каждой своя БД и свой подробный лог
+    pbx_list = utils.get_pbx_list()
+
+    p_start = datetime(2017, 1, 1)
+    p_end = datetime.now()
+
+    windows = [(p_start, p_end)]
+
+    if report_windows:
+        windows += importer.get_windows(p_start, p_end, report_windows)
+
+    # Режим предварительной оценки: краткий отчёт по выборке из sample_blocks блоков лога вместо полного разбора
+    sample_blocks = int(utils.get_options('main', 'sample_blocks', True, default='0') or 0)
+
+    if sample_blocks:
+        sample_log = {}
+
+        for pbx in pbx_list:
+            pbx_log = importer.get_sample_log(p_start, p_end, sample_blocks, pbx=pbx)
+
+            for value in pbx_log.values():
+                value['pbx'] = [pbx]
+
+            importer.merge_result(sample_log, pbx_log)
+
+        exporter.export_xls_brief(sample_log, 'estimate', True)
+        exporter.save_manifest()
+
+        return
+
+    # Импортируем списки гор. номеров из БД и звонки каждой АТС, несколько АТС - параллельно, по процессу на АТС
+    pbx_data = importer.get_pbx_list(pbx_list, p_start, p_end, windows, call_source)
+
     raw = {}
+    windows_log = {}
+    cdr_log = {}
 
-    for lk, lv in [('inc', at_inc_list), ('out', at_out_list)]:
-        for k, v in lv.items():
-            for i in v:
+    for pbx, data in zip(pbx_list, pbx_data):
+        for lk in ['inc', 'out']:
+            # Порядок сортируется, чтобы одинаковая тел. книга давала одинаковый отчёт, см. exporter.get_digest
+            for k, v in data[lk].items():
                 if k not in raw:
-                    raw[k] = {'inc': [], 'out': []}
+                    raw[k] = {'inc': [], 'out': [], 'pbx': []}
+
+                for i in sorted(v):
+                    raw[k][lk].append(get_ext_str(raw_ad, i))
+
+                if pbx not in raw[k]['pbx']:
+                    raw[k]['pbx'].append(pbx)
+
+        for w, w_log in (data['log'] or {}).items():
+            importer.merge_result(windows_log.setdefault(w, {}), w_log)
 
-                raw[k][lk].append(get_ext_str(raw_ad, i))
+        importer.merge_result(cdr_log, data['cdr'] or {})
 
     exporter.export_xls(raw)
 
-    # Импортируем звонки из подробного лога Астериска
-    full_log = importer.get_full_log(datetime(2017, 1, 1))
-    
+    full_log = windows_log.pop((p_start, p_end), None)
+
+    if full_log is not None and call_source == 'both':
+        exporter.export_xls_reconcile(full_log, cdr_log)
+
+    if full_log is None:
+        full_log = cdr_log
+
     exporter.export_xls_brief(full_log)
     exporter.export_xls_full(full_log)
 
+    for (w_start, w_end), w_log in sorted(windows_log.items()):
+        w_last = (w_end - timedelta(days=1)).date()
+        suffix = str(w_start.date()) if w_last == w_start.date() else '%s_%s' % (w_start.date(), w_last)
+
+        exporter.export_xls_brief(w_log, suffix)
+        exporter.export_xls_full(w_log, suffix)
+
+    exporter.save_manifest()
+
 
 if __name__ == '__main__':
     main()
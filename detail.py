@@ -0,0 +1,177 @@
+"""
+Модуль выгрузки детализации звонков в колоночные файлы.
+
+CallDetailWriter получает каждый завершённый звонок из importer.get_full_log и пакетами пишет их
+в файлы Parquet или Arrow IPC, разбитые по дням начала звонка:
+
+    detail_path/pbx=asterisk/day=2017-01-01/part-00000.parquet
+
+Такой каталог читается напрямую DuckDB (read_parquet('detail_path/*/*/*.parquet', hive_partitioning=1))
+или pandas (read_parquet('detail_path')) без повторного разбора лога.
+
+Для работы нужен пакет pyarrow.
+"""
+import os
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from utils import log, get_options
+
+
+# Столбцы детализации и их типы, имена совпадают с ключами звонка importer.get_call
+COLUMNS = [
+    ('id', 'string'),
+    ('direction', 'string'),
+    ('cm', 'string'),
+    ('user', 'string'),
+    ('start', 'timestamp[s]'),
+    ('ans', 'timestamp[s]'),
+    ('end', 'timestamp[s]'),
+    ('duration', 'int32'),
+    ('billsec', 'int32'),
+]
+
+EXTENSIONS = {
+    'parquet': 'parquet',
+    'arrow': 'arrow',
+}
+
+
+class CallDetailWriter:
+
+    def __init__(self, path, fmt='parquet', batch_size=50000):
+        """
+        Пакетная запись звонков в файлы, разбитые по дням. Каталоги дней, в которые пишет текущий запуск,
+        предварительно очищаются, поэтому повторный разбор того же периода не дублирует звонки.
+
+        :param path: string, корневой каталог детализации
+        :param fmt: string, формат файлов: "parquet" или "arrow" (Arrow IPC)
+        :param batch_size: int, сколько звонков накапливать в памяти до записи на диск
+        """
+        if fmt not in EXTENSIONS:
+            raise ValueError('Неизвестный формат детализации: %s' % fmt)
+
+        self.path = path
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.schema = pyarrow.schema([(name, pyarrow.type_for_alias(kind)) for name, kind in COLUMNS])
+
+        self.batch = {}  # {день: {столбец: [значения]}}
+        self.size = 0
+        self.parts = {}  # {день: количество записанных файлов}
+
+    def add(self, call):
+        """
+        Добавление звонка, при накоплении batch_size звонков пакет записывается на диск
+
+        :param call: {string: object}, звонок, см. importer.get_call
+        """
+        day = str(call['start'].date())
+
+        if day not in self.batch:
+            self.batch[day] = dict((name, []) for name, _ in COLUMNS)
+
+        for name, _ in COLUMNS:
+            self.batch[day][name].append(call[name])
+
+        self.size += 1
+
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def _get_folder(self, day):
+        """
+        Каталог дня, при первом обращении за запуск создаётся или очищается от прежних файлов
+
+        :param day: string, день "YYYY-MM-DD"
+        :return: string, путь к каталогу
+        """
+        folder = os.path.join(self.path, 'day=%s' % day)
+
+        if day not in self.parts:
+            self.parts[day] = 0
+
+            if os.path.exists(folder):
+                for file in os.listdir(folder):
+                    if file.startswith('part-'):
+                        os.remove(os.path.join(folder, file))
+            else:
+                os.makedirs(folder)
+
+        return folder
+
+    def flush(self):
+        """
+        Запись накопленного пакета: по новому файлу на каждый день пакета
+
+        """
+        for day, columns in self.batch.items():
+            table = pyarrow.Table.from_pydict(columns, schema=self.schema)
+
+            file = os.path.join(self._get_folder(day), 'part-%05d.%s' % (self.parts[day], EXTENSIONS[self.fmt]))
+            self.parts[day] += 1
+
+            if self.fmt == 'parquet':
+                pyarrow.parquet.write_table(table, file)
+            else:
+                with pyarrow.ipc.new_file(file, self.schema) as writer:
+                    writer.write_table(table)
+
+        self.batch = {}
+        self.size = 0
+
+    def restore(self, parts):
+        """
+        Продолжение прерванной выгрузки: счётчики файлов восстанавливаются, файлы, записанные после
+        сохранения счётчиков, удаляются
+
+        :param parts: {string: int}, {день: количество записанных файлов}, см. parts
+        """
+        self.parts = dict(parts)
+
+        for day, count in self.parts.items():
+            folder = os.path.join(self.path, 'day=%s' % day)
+
+            if not os.path.exists(folder):
+                continue
+
+            for file in os.listdir(folder):
+                if file.startswith('part-') and int(file[5:10]) >= count:
+                    os.remove(os.path.join(folder, file))
+
+    def close(self):
+        """
+        Запись остатка пакета
+
+        """
+        self.flush()
+
+
+def get_detail_writer(pbx=None):
+    """
+    Создание выгрузки детализации по параметрам detail_path и detail_format секции main
+
+    :param pbx: string, имя АТС, звонки каждой АТС пишутся в свой каталог detail_path/pbx=имя
+    :return: CallDetailWriter or None, если выгрузка не настроена или недоступна
+    """
+    path, fmt = get_options('main', ['detail_path', 'detail_format'], True, default='')
+
+    if not path:
+        return
+
+    if pyarrow is None:
+        log.error('Для выгрузки детализации звонков необходим пакет pyarrow')
+        return
+
+    if pbx:
+        path = os.path.join(path, 'pbx=%s' % pbx)
+
+    try:
+        return CallDetailWriter(path, fmt or 'parquet')
+    except ValueError as e:
+        log.error(e)
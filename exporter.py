@@ -1,9 +1,155 @@
+import hashlib
+import json
+import os
+
 import xlwt
 
 # import style as ts
 from utils import log, get_options
 
 
+QUANTILES = [0.5, 0.9, 0.99]  # Квантили длительности звонка и времени до ответа в отчётах
+
+# Версия формата отчётов, входит в хэш входных данных: при изменении вёрстки отчёты перестраиваются
+REPORT_VERSION = 2
+
+
+def _json_default(value):
+    """
+    Сериализация в JSON объектов статистики (скетчей) для вычисления хэша
+
+    :param value: object
+    :return: dict or string
+    """
+    return vars(value) if hasattr(value, '__dict__') else str(value)
+
+
+def get_digest(kind, raw):
+    """
+    Стабильный хэш входных данных отчёта
+
+    :param kind: string, вид отчёта
+    :param raw: object, входные данные отчёта
+    :return: string, sha1 в шестнадцатеричном виде
+    """
+    data = json.dumps([REPORT_VERSION, kind, raw], sort_keys=True, ensure_ascii=False, default=_json_default)
+
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _get_manifest_path():
+    """
+    Путь к манифесту отчётов из параметра report_manifest секции main
+
+    :return: string
+    """
+    return get_options('main', 'report_manifest', True, default='report_manifest.json')
+
+
+_manifest = None  # Манифест отчётов, загружается один раз за запуск, см. save_manifest
+_manifest_changed = False
+
+
+def _get_manifest():
+    """
+    Манифест отчётов, при первом обращении загружается из файла
+
+    :return: {string: string}, {путь_к_отчёту: хэш_входных_данных}
+    """
+    global _manifest
+
+    if _manifest is None:
+        _manifest = {}
+
+        try:
+            with open(_get_manifest_path(), encoding='utf-8') as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.error('Ошибка чтения манифеста отчётов: %s' % e)
+
+    return _manifest
+
+
+def save_manifest():
+    """
+    Запись манифеста отчётов, если за запуск сохранены новые отчёты
+
+    Вызывается один раз после выгрузки всех отчётов, файл заменяется атомарно.
+    """
+    global _manifest_changed
+
+    if not _manifest_changed:
+        return
+
+    path = _get_manifest_path()
+    tmp = '%s.tmp' % path
+
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(_manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+        os.replace(tmp, path)
+    except OSError as e:
+        log.error('Ошибка записи манифеста отчётов: %s' % e)
+        return
+
+    _manifest_changed = False
+
+
+def is_unchanged(path, digest):
+    """
+    Проверка, что отчёт уже построен по тем же входным данным и его можно не перестраивать
+
+    :param path: string, путь к файлу отчёта
+    :param digest: string, хэш входных данных, см. get_digest
+    :return: bool
+    """
+    if _get_manifest().get(os.path.abspath(path)) == digest and os.path.exists(path):
+        log.info('Данные не изменились, отчёт не перестраивается: %s' % path)
+        return True
+
+    return False
+
+
+def save_workbook(wb, path, digest):
+    """
+    Сохранение отчёта с атомарной заменой файла и записью хэша входных данных в манифест
+
+    Книга сохраняется во временный файл рядом с отчётом и переименовывается поверх него,
+    читатели отчёта никогда не видят частично записанный файл. Манифест изменяется в памяти,
+    на диск он записывается save_manifest.
+
+    :param wb: Workbook, книга
+    :param path: string, путь к файлу отчёта
+    :param digest: string, хэш входных данных, см. get_digest
+    :return: bool, True - если отчёт сохранён, None - если произошла ошибка сохранения
+    """
+    global _manifest_changed
+
+    tmp = '%s.tmp' % path
+
+    try:
+        wb.save(tmp)
+        os.replace(tmp, path)
+    except PermissionError as e:
+        log.error('Недостаточно прав для сохранения файла: %s' % e.filename)
+        return
+    except FileNotFoundError as e:
+        log.error('Неверный путь или имя файла: %s' % e.filename)
+        return
+    finally:
+        # После ошибки сохранения временный файл не нужен
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    _get_manifest()[os.path.abspath(path)] = digest
+    _manifest_changed = True
+
+    return True
+
+
 def export_xls(raw):
     """
     Выгрузка структуры телефонной книги в excel
@@ -19,6 +165,7 @@ def export_xls(raw):
     ws.write(0, 1, 'Гор. номер')
     ws.write(0, 2, 'Вх.')
     ws.write(0, 3, 'Исх.')
+    ws.write(0, 4, 'АТС')
 
     path = get_options('main', 'xls_path', True)
 
@@ -26,6 +173,11 @@ def export_xls(raw):
         log.critical('Ошибка чтения конфигурационного файла, см. ошибки выше')
         return
 
+    digest = get_digest('phonebook', raw)
+
+    if is_unchanged(path, digest):
+        return True
+
     line = 1
 
     for kc in sorted(raw):
@@ -34,19 +186,28 @@ def export_xls(raw):
 
         ws.write(line, 2, ', '.join(raw[kc]['inc']))
         ws.write(line, 3, ', '.join(raw[kc]['out']))
+        ws.write(line, 4, ', '.join(raw[kc].get('pbx', [])))
 
         line += 1
 
-    try:
-        wb.save(path)
-    except PermissionError as e:
-        log.error('Недостаточно прав для сохранения файла: %s' % e.filename)
-        return
-    except FileNotFoundError as e:
-        log.error('Неверный путь или имя файла: %s' % e.filename)
-        return
+    return save_workbook(wb, path, digest)
 
-    return True
+
+def get_path(option, suffix=''):
+    """
+    Путь к файлу отчёта из конфигурации, суффикс добавляется к имени файла перед расширением
+
+    :param option: string, параметр секции main с путём к файлу
+    :param suffix: string, суффикс имени файла, например период отчёта
+    :return: string or None, путь к файлу или None в случае ошибки чтения конфигурации
+    """
+    path = get_options('main', option, True)
+
+    if path and suffix:
+        root, ext = os.path.splitext(path)
+        path = '%s_%s%s' % (root, suffix, ext)
+
+    return path
 
 
 def format_time(seconds):
@@ -77,27 +238,69 @@ def format_time(seconds):
     return '%s:%02d:%02d' % (h, m, s)
     
     
-def export_xls_brief(raw):
+def write_quantiles_header(ws, col, title):
+    """
+    Заголовок столбцов квантилей, см. write_quantiles
+
+    :param ws: Worksheet, лист
+    :param col: int, первый столбец
+    :param title: string, направление звонков
+    """
+    ws.write_merge(0, 0, col, col + 2, '%s длит. (медиана, p90, p99)' % title)
+    ws.write_merge(0, 0, col + 3, col + 5, '%s до ответа (медиана, p90, p99)' % title)
+
+
+def write_quantiles(ws, line, col, stat):
+    """
+    Запись квантилей длительности звонка и времени до ответа, занимает 6 столбцов
+
+    :param ws: Worksheet, лист
+    :param line: int, строка
+    :param col: int, первый столбец
+    :param stat: {string: object}, статистика со скетчами, см. importer.new_stat
+    """
+    for key in ['duration', 'ring']:
+        for value in stat['sketch'][key].quantiles(QUANTILES):
+            ws.write(line, col, format_time(value) if value is not None else '')
+            col += 1
+
+
+def export_xls_brief(raw, suffix='', estimate=False):
     """
     Выгрузка краткой (без внутренних номеров) статистики звонков
     
     :param raw: 
+    :param suffix: string, суффикс имени файла, см. get_path
+    :param estimate: bool, статистика - оценка по выборке (importer.get_sample_log), добавляются
+        столбцы доверительных интервалов
     :return: 
     """
     wb = xlwt.Workbook()
-    ws = wb.add_sheet('Краткий список')
+    ws = wb.add_sheet('Краткий список (оценка)' if estimate else 'Краткий список')
 
     # Заголовок
     ws.write(0, 0, 'Гор. номер')
     ws.write_merge(0, 0, 1, 4, 'Вх.')
     ws.write_merge(0, 0, 5, 8, 'Исх.')
+    write_quantiles_header(ws, 9, 'Вх.')
+    write_quantiles_header(ws, 15, 'Исх.')
+    ws.write(0, 21, 'АТС')
+
+    if estimate:
+        ws.write_merge(0, 0, 22, 25, 'Вх. ± (95%)')
+        ws.write_merge(0, 0, 26, 29, 'Исх. ± (95%)')
 
-    path = get_options('main', 'xls_path_brief', True)
+    path = get_path('xls_path_brief', suffix)
 
     if not path:
         log.critical('Ошибка чтения конфигурационного файла, см. ошибки выше')
         return
 
+    digest = get_digest('brief_estimate' if estimate else 'brief', raw)
+
+    if is_unchanged(path, digest):
+        return True
+
     line = 1
     
     for kc in sorted(raw):
@@ -113,24 +316,29 @@ def export_xls_brief(raw):
         ws.write(line, 7, format_time(raw[kc]['out']['billsec']))
         ws.write(line, 8, raw[kc]['out']['answer'])
 
+        write_quantiles(ws, line, 9, raw[kc]['inc'])
+        write_quantiles(ws, line, 15, raw[kc]['out'])
+        ws.write(line, 21, ', '.join(raw[kc].get('pbx', [])))
+
+        if estimate:
+            for col, direction in [(22, 'inc'), (26, 'out')]:
+                ci = raw[kc][direction]['ci']
+
+                ws.write(line, col, format_time(ci['duration']))
+                ws.write(line, col + 1, ci['count'])
+                ws.write(line, col + 2, format_time(ci['billsec']))
+                ws.write(line, col + 3, ci['answer'])
+
         line += 1
         
-    try:
-        wb.save(path)
-    except PermissionError as e:
-        log.error('Недостаточно прав для сохранения файла: %s' % e.filename)
-        return
-    except FileNotFoundError as e:
-        log.error('Неверный путь или имя файла: %s' % e.filename)
-        return
+    return save_workbook(wb, path, digest)
 
-    return True
 
-
-def export_xls_full(raw):
+def export_xls_full(raw, suffix=''):
     """
     Выгрузка полной (с внутренними номерами) статистики звонков
     :param raw: 
+    :param suffix: string, суффикс имени файла, см. get_path
     :return: 
     """
     wb = xlwt.Workbook()
@@ -140,12 +348,20 @@ def export_xls_full(raw):
     ws.write(0, 0, 'Гор. номер')
     ws.write_merge(0, 0, 1, 5, 'Вх.')
     ws.write_merge(0, 0, 6, 10, 'Исх.')
+    write_quantiles_header(ws, 11, 'Вх.')
+    write_quantiles_header(ws, 17, 'Исх.')
+    ws.write(0, 23, 'АТС')
     
-    path = get_options('main', 'xls_path_full', True)
+    path = get_path('xls_path_full', suffix)
     
     if not path:
         log.critical('Ошибка чтения конфигурационного файла, см. ошибки выше')
         return
+
+    digest = get_digest('full', raw)
+
+    if is_unchanged(path, digest):
+        return True
     
     line = 1
     
@@ -166,6 +382,10 @@ def export_xls_full(raw):
         ws.write(line, 8, ko['count'])
         ws.write(line, 9, format_time(ko['billsec']))
         ws.write(line, 10, ko['answer'])
+
+        write_quantiles(ws, line, 11, ki)
+        write_quantiles(ws, line, 17, ko)
+        ws.write(line, 23, ', '.join(raw[kc].get('pbx', [])))
         
         inc_line = 0
         for inc in sorted(kiu):
@@ -173,6 +393,7 @@ def export_xls_full(raw):
             ws.write(line + inc_line, 1, inc)
             ws.write(line + inc_line, 4, format_time(kiu[inc]['billsec']))
             ws.write(line + inc_line, 5, kiu[inc]['answer'])
+            write_quantiles(ws, line + inc_line, 11, kiu[inc])
 
         out_line = 0
         for out in sorted(kou):
@@ -182,16 +403,77 @@ def export_xls_full(raw):
             ws.write(line + out_line, 8, kou[out]['count'])
             ws.write(line + out_line, 9, format_time(kou[out]['billsec']))
             ws.write(line + out_line, 10, kou[out]['answer'])
+            write_quantiles(ws, line + out_line, 17, kou[out])
 
         line += max([inc_line, out_line]) + 1
 
-    try:
-        wb.save(path)
-    except PermissionError as e:
-        log.error('Недостаточно прав для сохранения файла: %s' % e.filename)
-        return
-    except FileNotFoundError as e:
-        log.error('Неверный путь или имя файла: %s' % e.filename)
+    return save_workbook(wb, path, digest)
+
+
+def export_xls_reconcile(log_raw, cdr_raw):
+    """
+    Выгрузка сверки статистики звонков из подробного лога и из таблицы cdr
+
+    По каждому гор. номеру и направлению выводятся количество звонков, отвеченных и время разговора
+    из обоих источников и их разница, строки с расхождениями идут первыми.
+
+    :param log_raw: {string: {}}, статистика звонков из подробного лога, см. importer.get_full_log
+    :param cdr_raw: {string: {}}, статистика звонков из cdr, см. importer.get_cdr_log
+    :return: bool, True - если сверка выгружена, None - если произошла ошибка выгрузки
+    """
+    wb = xlwt.Workbook()
+    ws = wb.add_sheet('Сверка')
+
+    # Заголовок
+    ws.write(0, 0, 'Гор. номер')
+    ws.write(0, 1, 'Напр.')
+    ws.write_merge(0, 0, 2, 4, 'Звонков (лог, cdr, разница)')
+    ws.write_merge(0, 0, 5, 7, 'Отвечено (лог, cdr, разница)')
+    ws.write_merge(0, 0, 8, 10, 'Разговор (лог, cdr, разница)')
+
+    path = get_options('main', 'xls_path_reconcile', True)
+
+    if not path:
+        log.critical('Ошибка чтения конфигурационного файла, см. ошибки выше')
         return
-    
-    return True
+
+    digest = get_digest('reconcile', [log_raw, cdr_raw])
+
+    if is_unchanged(path, digest):
+        return True
+
+    empty = {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0}
+
+    rows = []
+
+    for kc in set(log_raw) | set(cdr_raw):
+        for direction in ['inc', 'out']:
+            kl = log_raw[kc][direction] if kc in log_raw else empty
+            kr = cdr_raw[kc][direction] if kc in cdr_raw else empty
+
+            diff = [kl[x] - kr[x] for x in ['count', 'answer', 'billsec']]
+
+            if kl['count'] or kr['count']:
+                rows.append((not any(diff), kc, direction, kl, kr, diff))
+
+    line = 1
+
+    for _, kc, direction, kl, kr, diff in sorted(rows, key=lambda x: x[:3]):
+        ws.write(line, 0, kc)
+        ws.write(line, 1, 'Вх.' if direction == 'inc' else 'Исх.')
+
+        ws.write(line, 2, kl['count'])
+        ws.write(line, 3, kr['count'])
+        ws.write(line, 4, diff[0])
+
+        ws.write(line, 5, kl['answer'])
+        ws.write(line, 6, kr['answer'])
+        ws.write(line, 7, diff[1])
+
+        ws.write(line, 8, format_time(kl['billsec']))
+        ws.write(line, 9, format_time(kr['billsec']))
+        ws.write(line, 10, '%s%s' % ('-' if diff[2] < 0 else '', format_time(abs(diff[2]))))
+
+        line += 1
+
+    return save_workbook(wb, path, digest)
@@ -1,31 +1,42 @@
+import math
+import os
+import pickle
 import re
+from bisect import bisect_right
 from collections import defaultdict
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import groupby, repeat
+from operator import itemgetter
 
 import pymysql
+import pymysql.cursors
 from ldap3 import Server, Connection, ALL, NTLM
 from ldap3.core.exceptions import LDAPSocketOpenError, LDAPBindError
 from pymysql.err import OperationalError
 
+from detail import get_detail_writer
+from logreader import read_log, read_log_from, read_blocks, get_block_step, get_log_length, get_period_files
+from normalize import normalize_num
+from sketch import KLLSketch
+from snapshot import get_parse_state
 from utils import log, get_options
 
 
-re_num = re.compile(r'.*(\d{3})(\d{2})(\d{2})$')
+re_ext = re.compile(r'^\d{4}$')
+
+STAT_KEYS = ['duration', 'billsec', 'count', 'answer']  # Суммируемые поля статистики
+CDR_STATE_VERSION = 2  # Версия файла состояния импорта cdr, меняется при изменении формата статистики
 
 
 def get_cm(num):
     """
-    Форматирование городского номера
+    Форматирование городского номера, см. normalize.normalize_num
     
     :param num: "Сырой" номер 
-    :return:  Форматированный номер, формат "XXX-XX-XX"
+    :return:  Форматированный номер, формат "XXX-XX-XX" или пустая строка, если номер не распознан
     """
-    num_gr = re_num.match(num)
-
-    if num_gr and len(num_gr.groups()) == 3:
-        return '%s-%s-%s' % (num_gr.group(1), num_gr.group(2), num_gr.group(3))
-
-    return ''
+    return normalize_num(num or '')
 
 
 def get_ad_list():
@@ -65,15 +76,16 @@ def get_ad_list():
     return raw
 
 
-def get_at_inc_list():
+def get_at_inc_list(section='asterisk'):
     """
     Импортируем список городских входящих номеров из БД АТС
 
+    :param section: string, секция конфигурации АТС
     :return: {string: {string}}, {гор_номер: {вн_номер, ...}}
     """
     raw = defaultdict(set)
 
-    options_list = get_options('asterisk', 'db')
+    options_list = get_options(section, 'db')
 
     if options_list:
         host, user, password, db = options_list
@@ -107,13 +119,15 @@ def get_at_inc_list():
                             ivr_list[str(ivr_id)][sel] = [ivr_im.group(1)]
 
                 # Запрос, привязка гор. номеров к вн. номерам или группам
-                cur.execute("SELECT extension, destination FROM incoming "
-                            "WHERE LENGTH(extension) = 7 OR LENGTH(extension) = 11")
+                cur.execute("SELECT extension, destination FROM incoming")
 
                 for ext, des in cur:
 
-                    # Формат гор. номера "###-##-##"
-                    cm = '%s-%s-%s' % (ext[-7:-4], ext[-4:-2], ext[-2:])
+                    # Формат гор. номера "###-##-##", нераспознанные номера (шаблоны, пустые DID) пропускаем
+                    cm = get_cm(ext)
+
+                    if not cm:
+                        continue
 
                     # Выбираем только группы
                     group = re_group.match(des)
@@ -146,15 +160,16 @@ def get_at_inc_list():
     return raw
 
 
-def get_at_out_list():
+def get_at_out_list(section='asterisk'):
     """
     Импортируем список исходящих номеров из БД АТС
     
+    :param section: string, секция конфигурации АТС
     :return:  {string: {string}}, {гор_номер: {вн_номер, ...}} 
     """
     raw = defaultdict(set)
 
-    options_list = get_options('asterisk', 'db')
+    options_list = get_options(section, 'db')
 
     if options_list:
         host, user, password, db = options_list
@@ -162,11 +177,13 @@ def get_at_out_list():
         try:
             with pymysql.connect(host, user, password, db) as cur:
 
-                cur.execute("SELECT extension, outboundcid FROM users "
-                            "WHERE LENGTH(outboundcid) = 11 or LENGTH(outboundcid) = 7")
+                cur.execute("SELECT extension, outboundcid FROM users")
 
                 for ext, out in cur:
-                    raw[get_cm(out)].add(ext)
+                    cm = get_cm(out)
+
+                    if cm:
+                        raw[cm].add(ext)
 
         except OperationalError as e:
             log.error(e)
@@ -174,15 +191,303 @@ def get_at_out_list():
     return raw
 
 
-def get_full_log(p_start, p_end=datetime.now()):
+def get_call(raw_id, value):
     """
-    Парсинг подробного лога Астериска, получение вх. и исх. звонков
-    
-    :param p_start: Дата начала парсинга
-    :param p_end:  Дата окончания парсинга, по умолчанию текущее время
-    :return: Словарь звоноков
+    Сборка звонка из разобранных строк подробного лога
+
+    :param raw_id: string, идентификатор звонка "дата-поток"
+    :param value: {string: object}, данные звонка, собранные парсером
+    :return: {string: object} or None, звонок или None, если исх. звонок без вн. или гор. номера
+    """
+    if value['direction'] == 'out' and ('cid' not in value or 'user' not in value):
+        return
+
+    user = value.get('user', value.get('call'))
+
+    duration = 0
+    billsec = 0
+
+    if 'start' in value and 'end' in value:
+        duration = (value['end'] - value['start']).seconds
+
+        if 'ans' in value:
+            billsec = (value['end'] - value['ans']).seconds
+
+    return {
+        'id': raw_id,
+        'direction': value['direction'],
+        'cm': get_cm(value['cid']),
+        'user': user,
+        'start': value.get('start'),
+        'ans': value.get('ans'),
+        'end': value.get('end'),
+        'duration': duration,
+        'billsec': billsec
+    }
+
+
+def new_stat(users=True):
+    """
+    Пустая статистика звонков гор. номера по направлению или вн. номера
+
+    Кроме сумм содержит скетчи длительности звонка и времени до ответа для расчёта квантилей
+
+    :param users: bool, добавить словарь статистики вн. номеров
+    :return: {string: object}
+    """
+    stat = {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0,
+            'sketch': {'duration': KLLSketch(), 'ring': KLLSketch()}}
+
+    if users:
+        stat['users'] = {}
+
+    return stat
+
+
+def _add_stat(stat, call):
+    """
+    Добавление звонка в статистику
+
+    :param stat: {string: object}, статистика, см. new_stat
+    :param call: {string: object}, звонок, см. get_call
+    """
+    stat['duration'] += call['duration']
+    stat['billsec'] += call['billsec']
+    stat['count'] += 1
+
+    if call['end']:
+        stat['sketch']['duration'].update(call['duration'])
+
+    if call['billsec']:
+        stat['answer'] += 1
+
+        if call['ans'] and call['start']:
+            stat['sketch']['ring'].update((call['ans'] - call['start']).seconds)
+
+
+def add_call(result, call):
+    """
+    Добавление звонка в статистику по гор. номерам
+
+    По исх. звонкам учитываются все вызовы вн. номера, по вх. - только отвеченные им
+
+    :param result: {string: {}}, статистика {гор_номер: {'inc': {}, 'out': {}}}
+    :param call: {string: object}, звонок, см. get_call
+    """
+    cm = call['cm']
+    user = call['user']
+
+    if cm not in result:
+        result[cm] = {'out': new_stat(), 'inc': new_stat()}
+
+    result_dir = result[cm][call['direction']]
+
+    if user and (call['direction'] == 'out' or call['billsec']):
+        if user not in result_dir['users']:
+            result_dir['users'][user] = new_stat(False)
+
+        _add_stat(result_dir['users'][user], call)
+
+    _add_stat(result_dir, call)
+
+
+def _merge_stat(stat, other):
+    """
+    Объединение статистики other в stat
+
+    :param stat: {string: object}, статистика, см. new_stat
+    :param other: {string: object}, статистика, не изменяется
+    """
+    for key in STAT_KEYS:
+        stat[key] += other[key]
+
+    # Полуширины доверительных интервалов независимых оценок складываются квадратично, см. get_sample_log
+    if 'ci' in other:
+        ci = stat.setdefault('ci', dict((key, 0) for key in STAT_KEYS))
+
+        for key in STAT_KEYS:
+            ci[key] = round(math.sqrt(ci[key] ** 2 + other['ci'][key] ** 2))
+
+    for key, sketch in other['sketch'].items():
+        stat['sketch'][key].merge(sketch)
+
+    for user, user_stat in other.get('users', {}).items():
+        if user not in stat['users']:
+            stat['users'][user] = new_stat(False)
+
+        _merge_stat(stat['users'][user], user_stat)
+
+
+def merge_result(result, other):
+    """
+    Объединение статистики звонков, собранной по разным частям лога или за разные периоды
+
+    :param result: {string: {}}, статистика, в которую добавляется other
+    :param other: {string: {}}, статистика, не изменяется
+    :return: {string: {}}, result
     """
-    raw = defaultdict(dict)
+    for cm, value in other.items():
+        if cm not in result:
+            result[cm] = {'out': new_stat(), 'inc': new_stat()}
+
+        for direction in ['inc', 'out']:
+            _merge_stat(result[cm][direction], value[direction])
+
+        if 'pbx' in value:
+            result[cm]['pbx'] = sorted(set(result[cm].get('pbx', [])) | set(value['pbx']))
+
+    return result
+
+
+def get_windows(p_start, p_end, granularity):
+    """
+    Разбиение периода на календарные окна отчётов
+
+    :param p_start: datetime, дата начала периода
+    :param p_end: datetime, дата окончания периода
+    :param granularity: string, размер окна: "day", "week" (с понедельника) или "month"
+    :return: [(datetime, datetime)], список окон [начало, конец)
+    """
+    windows = []
+
+    start = datetime(p_start.year, p_start.month, p_start.day)
+
+    if granularity == 'week':
+        start -= timedelta(days=start.weekday())
+    elif granularity == 'month':
+        start = start.replace(day=1)
+    elif granularity != 'day':
+        raise ValueError('Неизвестный размер окна: %s' % granularity)
+
+    while start <= p_end:
+        if granularity == 'day':
+            end = start + timedelta(days=1)
+        elif granularity == 'week':
+            end = start + timedelta(days=7)
+        else:
+            end = (start + timedelta(days=31)).replace(day=1)
+
+        windows.append((start, end))
+        start = end
+
+    return windows
+
+
+def get_window_lookup(windows):
+    """
+    Таблица поиска окон по времени
+
+    Границы всех окон делят время на элементарные интервалы, для каждого интервала заранее
+    вычисляется список покрывающих его окон, поиск окон звонка - один bisect по границам.
+
+    :param windows: [(datetime, datetime)], список окон [начало, конец), окна могут пересекаться
+    :return: ([datetime], [[(datetime, datetime)]]), границы интервалов и окна каждого интервала
+    """
+    bounds = sorted(set(x for window in windows for x in window))
+    covers = [[w for w in windows if w[0] <= b < w[1]] for b in bounds]
+
+    return bounds, covers
+
+
+def add_call_windows(results, lookup, call):
+    """
+    Добавление звонка в статистику всех окон, в которые попадает время его начала
+
+    :param results: {(datetime, datetime): {}}, статистика по окнам
+    :param lookup: ([datetime], [[(datetime, datetime)]]), таблица поиска окон, см. get_window_lookup
+    :param call: {string: object}, звонок, см. get_call
+    """
+    bounds, covers = lookup
+
+    if not bounds or call['start'] < bounds[0]:
+        return
+
+    for w in covers[bisect_right(bounds, call['start']) - 1]:
+        add_call(results[w], call)
+
+
+def _finish_call(raw_id, raw, closed, results, lookup, detail):
+    """
+    Завершение звонка: звонок убирается из открытых и добавляется в статистику и детализацию
+
+    :param raw_id: string, идентификатор звонка
+    :param raw: {string: {}}, открытые звонки
+    :param closed: {string}, идентификаторы завершённых звонков
+    :param results: {} or {(datetime, datetime): {}}, статистика или статистика по окнам
+    :param lookup: таблица поиска окон, см. get_window_lookup, None - без окон
+    :param detail: CallDetailWriter or None, выгрузка детализации звонков
+    """
+    call = get_call(raw_id, raw.pop(raw_id))
+    closed.add(raw_id)
+
+    if not call:
+        return
+
+    if detail:
+        detail.add(call)
+
+    if lookup:
+        add_call_windows(results, lookup, call)
+    else:
+        add_call(results, call)
+
+
+def get_log_path(pbx=None):
+    """
+    Путь к подробному логу АТС
+
+    :param pbx: string, секция конфигурации АТС, путь берётся из её параметра full_path,
+        по умолчанию - из секции main
+    :return: string or None в случае ошибки чтения конфигурации
+    """
+    full_path = get_options(pbx, 'full_path', True, default='') if pbx else ''
+    full_path = full_path or get_options('main', 'full_path', True)
+
+    if not full_path:
+        log.critical('Ошибка чтения конфигурационного файла, см. ошибки выше')
+
+    return full_path
+
+
+def get_span_cache_path(pbx=None):
+    """
+    Путь к кэшу меток времени файлов лога АТС, см. logreader.get_spans
+
+    У каждой АТС свой файл кэша, поэтому процессы разных АТС (см. get_pbx_list) не перезаписывают его друг у друга.
+
+    :param pbx: string, секция конфигурации АТС, её имя добавляется к имени файла из параметра span_cache секции main
+    :return: string
+    """
+    cache_path = get_options('main', 'span_cache', True, default='') or 'log_spans.json'
+
+    if not pbx:
+        return cache_path
+
+    root, ext = os.path.splitext(cache_path)
+
+    return '%s_%s%s' % (root, pbx, ext)
+
+
+def parse_log(lines, p_start, p_end, results, lookup=None, detail=None, id_prefix='', finish_open=True, state=None,
+              open_calls=None):
+    """
+    Разбор строк подробного лога Астериска, звонки добавляются в статистику по мере завершения
+
+    :param lines: iterable, строки лога
+    :param p_start: datetime, дата начала периода
+    :param p_end: datetime, дата окончания периода
+    :param results: {} or {(datetime, datetime): {}}, статистика или статистика по окнам
+    :param lookup: таблица поиска окон, см. get_window_lookup, None - без окон
+    :param detail: CallDetailWriter, выгрузка детализации
+    :param id_prefix: string, префикс идентификаторов звонков
+    :param finish_open: bool, учитывать звонки, не завершённые к концу строк
+    :param state: ParseState, снимки разбора: открытые звонки берутся из него, через каждые
+        snapshot_lines строк состояние сохраняется, см. snapshot.py
+    :param open_calls: {string: datetime}, если задан, в него записываются id и время начала звонков,
+        открытых к концу строк (их статистика ещё может измениться)
+    :return: results
+    """
+    raw = state.raw if state else defaultdict(dict)
 
     re_line = re.compile(r'^\[(.*?)\] VERBOSE\[(\d+)\] (\w+\.c): (.+)')
     
@@ -199,222 +504,555 @@ def get_full_log(p_start, p_end=datetime.now()):
     re_inc_end = re.compile(r'== Spawn.*? exited non-zero.*')
     # re_inc_xfer = re.compile(r'.*?(\d{4})@from-internal-xfer.*')
 
-    full_path = get_options('main', 'full_path', True)
+    # Исх. звонок завершается по первой строке окончания и сразу попадает в статистику. Вх. звонок завершается
+    # по последней строке окончания (первой обычно бывает выход из макроса), поэтому попадает в статистику,
+    # когда поток начинает новый звонок или когда строк звонка больше быть не может - через сутки после его id
+    closed, day = (state.closed, state.day) if state else (set(), None)
+    raw_time = None
 
-    with open(full_path) as f:
-        for line in f:
-            line_match = re_line.match(line)
+    for line in lines:
+        if state and state.tick():
+            state.save(closed, day, raw_time, results, detail)
 
-            if not line_match:
-                continue
+        line_match = re_line.match(line)
 
-            raw_mod = line_match.group(3).strip()
-            raw_time = datetime.strptime(line_match.group(1).strip(), '%Y-%m-%d %H:%M:%S')
-            raw_line = line_match.group(4).strip()
+        if not line_match:
+            continue
+
+        raw_mod = line_match.group(3).strip()
+        raw_time = datetime.strptime(line_match.group(1).strip(), '%Y-%m-%d %H:%M:%S')
+        raw_line = line_match.group(4).strip()
+
+        raw_id = '%s%s-%s' % (id_prefix, raw_time.date(), line_match.group(2))
+        
+        if raw_time < p_start or raw_time > p_end:
+            continue
+
+        if raw_time.date() != day:
+            day = raw_time.date()
+
+            # Строки звонка могут прийти только с id текущих или предыдущих суток
+            bound = '%s%s' % (id_prefix, day - timedelta(days=1))
+
+            for x in [x for x in raw if x < bound]:
+                _finish_call(x, raw, closed, results, lookup, detail)
+
+            closed = set(x for x in closed if x >= bound)
+
+        out_init_match = re_out_init.match(raw_line)
+        inc_init_match = re_inc_init.match(raw_line) if not out_init_match else None
+
+        # Номер потока может использоваться повторно в те же сутки: строка начала открывает новый звонок,
+        # прочие строки завершённого звонка пропускаются
+        if out_init_match or inc_init_match:
+            if raw_id in raw:
+                _finish_call(raw_id, raw, closed, results, lookup, detail)
+
+            closed.discard(raw_id)
+        elif raw_id in closed:
+            continue
+
+        # Звонок, начатый до полуночи (обычно в предыдущем ротированном файле), продолжается под прежним id.
+        # Строка начала звонка всегда относится к новому звонку, даже если прежний звонок потока не завершён
+        if raw_id not in raw and not (out_init_match or inc_init_match):
+            prev_id = '%s%s-%s' % (id_prefix, raw_time.date() - timedelta(days=1), line_match.group(2))
+
+            if prev_id in raw:
+                raw_id = prev_id
+
+        if raw_id not in raw:
+            if out_init_match:
+                raw[raw_id]['start'] = raw_time
+                raw[raw_id]['direction'] = 'out'
 
-            raw_id = '%s-%s' % (raw_time.date(), line_match.group(2))
-            
-            if raw_time < p_start or raw_time > p_end:
                 continue
 
-            if raw_id not in raw:
-                out_init_match = re_out_init.match(raw_line)
+            if inc_init_match:
+                raw[raw_id]['start'] = raw_time
+                raw[raw_id]['direction'] = 'inc'
+                raw[raw_id]['cid'] = inc_init_match.group(1)
+
+            continue
 
-                if out_init_match:
-                    raw[raw_id]['start'] = raw_time
-                    raw[raw_id]['direction'] = 'out'
+        if raw[raw_id]['direction'] == 'out':
+            if 'user' not in raw[raw_id]:
+                out_user_match = re_out_user.match(raw_line)
+
+                if out_user_match:
+                    raw[raw_id]['user'] = out_user_match.group(1)
 
                     continue
 
-                inc_init_match = re_inc_init.match(raw_line)
+            if 'cid' not in raw[raw_id]:
+                out_cid_match = re_out_cid.match(raw_line)
 
-                if inc_init_match:
-                    raw[raw_id]['start'] = raw_time
-                    raw[raw_id]['direction'] = 'inc'
-                    raw[raw_id]['cid'] = inc_init_match.group(1)
+                if out_cid_match:
+                    raw[raw_id]['cid'] = out_cid_match.group(1)
 
-                continue
+                    continue
+
+            if 'ans' not in raw[raw_id] and raw_mod == 'app_dial.c':
+                out_ans_match = re_out_ans.match(raw_line)
+
+                if out_ans_match:
+                    raw[raw_id]['ans'] = raw_time
+
+                    continue
+
+            if 'end' not in raw[raw_id]:
+
+                out_end_match = re_out_end.match(raw_line)
+
+                if out_end_match:
+                    raw[raw_id]['end'] = raw_time
+                    _finish_call(raw_id, raw, closed, results, lookup, detail)
+
+                    continue
+
+        if raw[raw_id]['direction'] == 'inc':
+
+            if raw_mod == 'app_dial.c':
+                # if 'xfer' in raw[raw_id]:
+                #     inc_ans_match = re_inc_ans.match(raw_line)
+                #
+                #     if inc_ans_match:
+                #         raw[raw_id]['xfer']['ans'] = raw_time
+                #
+                #         continue
+
+                inc_user_match = re_inc_user.match(raw_line)
+
+                if inc_user_match:
+                    raw[raw_id]['user'] = inc_user_match.group(1)
+
+                inc_ans_match = re_inc_ans.match(raw_line)
+
+                if inc_ans_match:
+                    raw[raw_id]['ans'] = raw_time
+
+                    continue
 
-            if raw[raw_id]['direction'] == 'out':
                 if 'user' not in raw[raw_id]:
-                    out_user_match = re_out_user.match(raw_line)
+                    inc_call_match = re_inc_call.match(raw_line)
 
-                    if out_user_match:
-                        raw[raw_id]['user'] = out_user_match.group(1)
+                    if inc_call_match:
+                        raw[raw_id]['call'] = inc_call_match.group(1)
 
                         continue
 
-                if 'cid' not in raw[raw_id]:
-                    out_cid_match = re_out_cid.match(raw_line)
+            inc_end_match = re_inc_end.match(raw_line)
 
-                    if out_cid_match:
-                        raw[raw_id]['cid'] = out_cid_match.group(1)
+            if inc_end_match:
+                raw[raw_id]['end'] = raw_time
 
-                        continue
+                continue
+            
+            # inc_xfer_match = re_inc_xfer.match(raw_line)
+            #
+            # if inc_xfer_match:
+            #     raw[raw_id]['xfer'] = {
+            #         'start': raw_time,
+            #         'user': inc_xfer_match.group(1)
+            #     }
 
-                if 'ans' not in raw[raw_id] and raw_mod == 'app_dial.c':
-                    out_ans_match = re_out_ans.match(raw_line)
+    # Незавершённые к концу периода звонки, без finish_open - только звонки со строкой окончания
+    for raw_id in list(raw):
+        if open_calls is not None:
+            open_calls[raw_id] = raw[raw_id]['start']
 
-                    if out_ans_match:
-                        raw[raw_id]['ans'] = raw_time
+        if finish_open or 'end' in raw[raw_id]:
+            _finish_call(raw_id, raw, closed, results, lookup, detail)
 
-                        continue
+    return results
 
-                if 'end' not in raw[raw_id]:
 
-                    out_end_match = re_out_end.match(raw_line)
+def _restore_windows(snapshot, windows):
+    """
+    Статистика окон из снимка разбора для окон текущего запуска
 
-                    if out_end_match:
-                        raw[raw_id]['end'] = raw_time
+    Все звонки снимка начались не позже его последней строки. Окно с тем же началом переносится, если его конец
+    не изменился или оба конца позже этой строки (например, окно всего периода, заканчивающееся текущим
+    временем). Новое окно, начинающееся после неё, получает пустую статистику.
 
-                        continue
+    :param snapshot: {string: object}, снимок, см. snapshot.ParseState.load
+    :param windows: [(datetime, datetime)], окна текущего запуска
+    :return: {(datetime, datetime): {}} or None, если окна несовместимы со снимком
+    """
+    bound = snapshot['time']
 
-            if raw[raw_id]['direction'] == 'inc':
+    if bound is None:
+        return dict((w, {}) for w in windows)
 
-                if raw_mod == 'app_dial.c':
-                    # if 'xfer' in raw[raw_id]:
-                    #     inc_ans_match = re_inc_ans.match(raw_line)
-                    #
-                    #     if inc_ans_match:
-                    #         raw[raw_id]['xfer']['ans'] = raw_time
-                    #
-                    #         continue
+    saved = dict(snapshot['results'])
+    results = dict((w, saved.pop(w)) for w in windows if w in saved)
 
-                    inc_user_match = re_inc_user.match(raw_line)
+    # Окно всего периода может начинаться одновременно с календарным, каждое окно снимка переносится один раз
+    for w_start, w_end in windows:
+        if (w_start, w_end) in results:
+            continue
 
-                    if inc_user_match:
-                        raw[raw_id]['user'] = inc_user_match.group(1)
+        match = [w for w in saved if w[0] == w_start and w[1] > bound and w_end > bound]
 
-                    inc_ans_match = re_inc_ans.match(raw_line)
+        if match:
+            results[(w_start, w_end)] = saved.pop(match[0])
+        elif w_start > bound:
+            results[(w_start, w_end)] = {}
+        else:
+            return
 
-                    if inc_ans_match:
-                        raw[raw_id]['ans'] = raw_time
+    return results
 
-                        continue
 
-                    if 'user' not in raw[raw_id]:
-                        inc_call_match = re_inc_call.match(raw_line)
+def get_full_log(p_start, p_end=datetime.now(), windows=None, detail=None, pbx=None, state=None, finish_open=True,
+                 open_calls=None):
+    """
+    Парсинг подробного лога Астериска, получение вх. и исх. звонков
 
-                        if inc_call_match:
-                            raw[raw_id]['call'] = inc_call_match.group(1)
+    Читается основной файл лога и его ротированные копии, см. logreader.read_log.
+    Если заданы окна отчётов, статистика всех окон собирается за один проход по логу,
+    звонок относится к окнам по времени начала.
+    
+    :param p_start: Дата начала парсинга
+    :param p_end:  Дата окончания парсинга, по умолчанию текущее время
+    :param windows: [(datetime, datetime)] or string, список окон [начало, конец) или размер
+        календарного окна ("day", "week", "month"), см. get_windows
+    :param detail: CallDetailWriter, выгрузка детализации, звонки передаются в неё по мере завершения
+    :param pbx: string, секция конфигурации АТС: путь к логу берётся из её параметра full_path
+        (по умолчанию - из секции main), имя АТС добавляется к идентификаторам звонков
+    :param state: ParseState, снимки разбора: если прежний разбор с тем же началом периода прерван и его окна
+        совместимы с текущими (см. _restore_windows), чтение лога продолжается с позиции последнего снимка
+    :param finish_open: bool, учитывать звонки, не завершённые к концу лога, см. parse_log
+    :param open_calls: {string: datetime}, звонки, открытые к концу лога, см. parse_log
+    :return: Словарь звоноков, при заданных окнах - {(начало, конец): словарь_звонков}
+    """
+    full_path = get_log_path(pbx)
 
-                            continue
+    if not full_path:
+        return {}
 
-                inc_end_match = re_inc_end.match(raw_line)
+    # Потоки разных АТС могут иметь одинаковые номера, поэтому id звонка содержит имя АТС
+    id_prefix = '%s:' % pbx if pbx else ''
+    cache_path = get_span_cache_path(pbx)
 
-                if inc_end_match:
-                    raw[raw_id]['end'] = raw_time
+    if isinstance(windows, str):
+        windows = get_windows(p_start, p_end, windows)
 
-                    continue
-                
-                # inc_xfer_match = re_inc_xfer.match(raw_line)
-                #
-                # if inc_xfer_match:
-                #     raw[raw_id]['xfer'] = {
-                #         'start': raw_time,
-                #         'user': inc_xfer_match.group(1)
-                #     }
+    lookup = get_window_lookup(windows) if windows is not None else None
+    results = {} if windows is None else dict((w, {}) for w in windows)
+
+    if not state:
+        return parse_log(read_log(full_path, p_start, p_end, cache_path), p_start, p_end, results, lookup, detail,
+                         id_prefix, finish_open, open_calls=open_calls)
+
+    # Окна в ключ не входят: конец окна всего периода (текущее время) и число календарных окон меняются
+    # между запусками, совместимость окон со снимком проверяет _restore_windows
+    snapshot = state.load(repr((str(p_start), pbx, windows is None)))
+
+    if snapshot:
+        restored = snapshot['results'] if windows is None else _restore_windows(snapshot, windows)
+
+        if restored is None:
+            log.info('Окна отчётов несовместимы со снимком разбора, разбор начинается заново')
+            state.reset()
+        else:
+            log.info('Разбор лога продолжается со снимка %s, позиция %s' % (state.path, state.position))
+            results = restored
+
+            if detail and snapshot['parts']:
+                detail.restore(snapshot['parts'])
+
+    lines = state.track(read_log_from(full_path, p_start, p_end, state.position, cache_path))
+
+    results = parse_log(lines, p_start, p_end, results, lookup, detail, id_prefix, finish_open, state, open_calls)
+    state.close()
+
+    return results
+
+
+def get_sample_log(p_start, p_end=None, blocks=100, block_size=1024 * 1024, pbx=None):
+    """
+    Быстрая оценка статистики звонков по выборке равномерно расположенных блоков лога
+
+    Каждый блок разбирается отдельно, учитываются только звонки, начатые и завершённые внутри блока,
+    поэтому длинные звонки недооцениваются тем сильнее, чем меньше block_size. Суммы масштабируются
+    на долю прочитанных данных, для каждой суммы считается 95% доверительный интервал по разбросу
+    между блоками (с поправкой на конечность совокупности блоков).
+
+    :param p_start: datetime, дата начала периода
+    :param p_end: datetime, дата окончания периода, по умолчанию текущее время
+    :param blocks: int, желаемое количество блоков, см. logreader.get_block_step
+    :param block_size: int, размер блока, байт
+    :param pbx: string, секция конфигурации АТС, см. get_full_log
+    :return: Словарь звонков в формате get_full_log с оценками сумм, у статистики гор. номеров
+        по направлению добавлен ключ 'ci' - полуширины доверительных интервалов сумм
+    """
+    p_end = p_end or datetime.now()
+
+    full_path = get_log_path(pbx)
+
+    if not full_path:
+        return {}
+
+    id_prefix = '%s:' % pbx if pbx else ''
+
+    cache_path = get_span_cache_path(pbx)
+
+    paths = get_period_files(full_path, p_start, p_end, cache_path)
+    length = get_log_length(paths, cache_path)
+    step = get_block_step(length, blocks, block_size)
 
     result = {}
+    sums = defaultdict(int)  # {(гор_номер, направление, поле): сумма квадратов значений по блокам}
+    count = 0
 
-    for value in raw.values():
-        if value['direction'] == 'out':
-            if 'cid' in value and 'user' in value:
-                cm = get_cm(value['cid'])
-                user = value['user']
+    for lines in read_blocks(paths, step, block_size):
+        block = parse_log(lines, p_start, p_end, {}, id_prefix=id_prefix, finish_open=False)
 
-                duration = 0
-                billsec = 0
+        for cm, value in block.items():
+            for direction in ['inc', 'out']:
+                for key in STAT_KEYS:
+                    sums[(cm, direction, key)] += value[direction][key] ** 2
 
-                if 'start' in value and 'end' in value:
-                    duration = (value['end'] - value['start']).seconds
+        merge_result(result, block)
+        count += 1
 
-                    if 'ans' in value:
-                        billsec = (value['end'] - value['ans']).seconds
+    if not count:
+        return result
 
-                if cm not in result:
-                    result[cm] = {'out': {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0, 'users': {}},
-                                  'inc': {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0, 'users': {}}
-                                  }
+    # Блоки сетки без строк в выборке тоже есть, с нулевыми значениями. Последний блок может
+    # выходить за конец лога, поэтому доля выборки - прочитанные байты к размеру лога
+    cells = range(0, length, step)
+    count = max(count, len(cells))
+    sampled = sum(min(block_size, length - pos) for pos in cells)
+    scale = length / sampled if sampled else step / block_size
 
-                result_out = result[cm]['out']
+    population = count * scale
+    fpc = max(0.0, 1 - count / population)
 
-                if user not in result_out['users']:
-                    result_out['users'][user] = {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0}
+    for cm, value in result.items():
+        for direction in ['inc', 'out']:
+            stat = value[direction]
+            stat['ci'] = {}
 
-                result_out['duration'] += duration
-                result_out['billsec'] += billsec
-                result_out['count'] += 1
+            for key in STAT_KEYS:
+                mean = stat[key] / count
+                var = (sums[(cm, direction, key)] - count * mean ** 2) / (count - 1) if count > 1 else 0
 
-                result_out['users'][user]['duration'] += duration
-                result_out['users'][user]['billsec'] += billsec
-                result_out['users'][user]['count'] += 1
+                stat['ci'][key] = round(1.96 * population * math.sqrt(max(var, 0) / count * fpc))
+                stat[key] = round(stat[key] * scale)
 
-                if billsec:
-                    result_out['answer'] += 1
-                    result_out['users'][user]['answer'] += 1
+            for user_stat in stat['users'].values():
+                for key in STAT_KEYS:
+                    user_stat[key] = round(user_stat[key] * scale)
 
-        else:
-            cm = get_cm(value['cid'])
-            user = None
-            # xuser = None
+    return result
 
-            if 'user' in value:
-                user = value['user']
-            elif 'call' in value:
-                user = value['call']
 
-            # if 'xfer' in value:
-            #     if 'user' in value['xfer'] and 'ans' in value['xfer']:
-            #         xuser = value['xfer']['user']
+def _load_state(state_path):
+    """
+    Загрузка сохранённого состояния инкрементального импорта
 
-            duration = 0
-            billsec = 0
+    :param state_path: string, путь к файлу состояния
+    :return: {string: object} or None, если файла нет или он повреждён
+    """
+    try:
+        with open(state_path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        log.error('Ошибка чтения файла состояния %s: %s' % (state_path, e))
 
-            if 'start' in value:
-                if 'end' in value:
-                    duration = (value['end'] - value['start']).seconds
 
-                    if 'ans' in value:
-                        billsec = (value['end'] - value['ans']).seconds
+def _save_state(state_path, state):
+    """
+    Сохранение состояния инкрементального импорта
 
-            if cm not in result:
-                result[cm] = {'out': {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0, 'users': {}},
-                              'inc': {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0, 'users': {}}
-                              }
+    :param state_path: string, путь к файлу состояния
+    :param state: {string: object}, состояние
+    """
+    try:
+        with open(state_path, 'wb') as f:
+            pickle.dump(state, f)
+    except OSError as e:
+        log.error('Ошибка записи файла состояния %s: %s' % (state_path, e))
 
-            result_inc = result[cm]['inc']
 
-            if user and billsec:
-                if user not in result_inc['users']:
-                    result_inc['users'][user] = {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0}
+def get_cdr_call(rows, ext_cm):
+    """
+    Сборка звонка из строк таблицы cdr с одним uniqueid
 
-                user_duration = duration
-                user_billsec = billsec
+    Вызов группы даёт по строке на каждый вн. номер, звонок берётся по отвеченной строке, если она есть.
 
-                # if xuser:
-                #     if xuser not in result[cm]['inc']['users']:
-                #         result[cm]['inc']['users'][xuser] = {'duration': 0, 'billsec': 0, 'count': 0, 'answer': 0}
-                #
-                #     user_duration = (value['xfer']['ans'] - value['start']).seconds
-                #     user_billsec = (value['xfer']['ans'] - value['ans']).seconds
-                #
-                #     if duration:
-                #         result[cm]['inc']['users'][xuser]['duration'] += (value['end'] - value['xfer']['ans']).seconds
-                #         result[cm]['inc']['users'][xuser]['billsec'] += (value['end'] - value['xfer']['ans']).seconds
-                #         result[cm]['inc']['users'][xuser]['count'] += 1
-                #         result[cm]['inc']['users'][xuser]['answer'] += 1
+    :param rows: [tuple], строки (calldate, uniqueid, src, dst, did, duration, billsec, disposition)
+    :param ext_cm: {string: string}, {вн_номер: гор_номер} для исх. звонков
+    :return: {string: object} or None, звонок, см. get_call, или None для внутренних звонков
+    """
+    answered = [x for x in rows if x[7] == 'ANSWERED']
+    calldate, uniqueid, src, dst, did, duration, billsec, disposition = answered[0] if answered else rows[0]
+
+    if did:
+        direction = 'inc'
+        cm = get_cm(did)
+        user = dst if re_ext.match(dst) else None
+    elif src in ext_cm and not re_ext.match(dst):
+        direction = 'out'
+        cm = ext_cm[src]
+        user = src
+    else:
+        return
+
+    billsec = billsec if disposition == 'ANSWERED' else 0
+
+    return {
+        'id': uniqueid,
+        'direction': direction,
+        'cm': cm,
+        'user': user,
+        'start': calldate,
+        'ans': calldate + timedelta(seconds=duration - billsec) if billsec else None,
+        'end': calldate + timedelta(seconds=duration),
+        'duration': duration,
+        'billsec': billsec
+    }
+
+
+def get_cdr_log(p_start, p_end=None, state_path='cdr_state.pickle', section='asterisk', out_list=None,
+                overlap=10800):
+    """
+    Получение вх. и исх. звонков из таблицы cdr БД Астериска, альтернатива разбору подробного лога
+
+    Строки читаются потоком (SSCursor) по возрастанию (calldate, uniqueid). Статистика, последняя прочитанная
+    дата и uniqueid звонков за последние overlap секунд сохраняются в state_path, повторный запуск с той же
+    датой начала дочитывает только новые строки.
+
+    Строка cdr записывается при завершении звонка, а calldate - время его начала, поэтому звонок, шедший
+    во время прошлого запуска, появляется в таблице с calldate раньше последней прочитанной даты. Повторный
+    запуск перечитывает строки за overlap секунд до неё и пропускает уже учтённые uniqueid.
+
+    :param p_start: datetime, дата начала периода
+    :param p_end: datetime, дата окончания периода, по умолчанию текущее время
+    :param state_path: string, путь к файлу состояния, None - без инкрементального импорта
+    :param section: string, секция конфигурации АТС
+    :param out_list: {string: {string}}, исх. номера АТС, см. get_at_out_list, по умолчанию загружаются из БД
+    :param overlap: int, перекрытие повторного чтения, секунд, не меньше максимальной длительности звонка
+    :return: Словарь звонков, формат как у get_full_log
+    """
+    p_end = p_end or datetime.now()
+    overlap = timedelta(seconds=overlap)
+
+    result = {}
+    last = p_start
+    seen = {}  # {uniqueid: calldate}, учтённые звонки за последние overlap секунд
+
+    state = _load_state(state_path) if state_path else None
+
+    # Состояние другой версии (например, без скетчей в статистике) не продолжается, импорт начинается заново
+    if state and state.get('version') == CDR_STATE_VERSION and state['start'] == p_start and state['last'] <= p_end:
+        result = state['result']
+        last = state['last']
+        seen = state['seen']
+
+    options_list = get_options(section, 'cdr_db')
+
+    if not options_list:
+        return result
 
-                result_inc['users'][user]['duration'] += user_duration
-                result_inc['users'][user]['billsec'] += user_billsec
-                result_inc['users'][user]['count'] += 1
-                result_inc['users'][user]['answer'] += 1
+    host, user, password, db = options_list
 
-            result_inc['duration'] += duration
-            result_inc['billsec'] += billsec
-            result_inc['count'] += 1
+    # Исх. гор. номер в cdr не хранится, берётся из настроек вн. номера
+    ext_cm = {}
 
-            if billsec:
-                result_inc['answer'] += 1
+    for cm, exts in (out_list or get_at_out_list(section)).items():
+        for ext in exts:
+            ext_cm[ext] = cm
+
+    try:
+        with pymysql.connect(host, user, password, db, cursorclass=pymysql.cursors.SSCursor) as cur:
+            cur.execute("SELECT calldate, uniqueid, src, dst, did, duration, billsec, disposition FROM cdr "
+                        "WHERE calldate >= %s AND calldate <= %s "
+                        "ORDER BY calldate, uniqueid", (max(p_start, last - overlap), p_end))
+
+            for uniqueid, group in groupby(cur, itemgetter(1)):
+                rows = list(group)
+                last = max(last, rows[-1][0])
+
+                if uniqueid in seen:
+                    continue
+
+                seen[uniqueid] = rows[0][0]
+
+                call = get_cdr_call(rows, ext_cm)
+
+                if call:
+                    add_call(result, call)
+
+    except OperationalError as e:
+        log.error(e)
+        return result
+
+    if state_path:
+        seen = dict((k, v) for k, v in seen.items() if v >= last - overlap)
+
+        _save_state(state_path, {'version': CDR_STATE_VERSION, 'start': p_start, 'last': last, 'seen': seen,
+                                 'result': result})
 
     return result
+
+
+def get_pbx(pbx, p_start, p_end, windows, call_source='log'):
+    """
+    Загрузка настроек и звонков одной АТС, для нескольких АТС выполняется параллельно в пуле процессов
+
+    Статистика каждого гор. номера помечается именем АТС (ключ 'pbx'), см. merge_result
+
+    :param pbx: string, секция конфигурации АТС
+    :param p_start: datetime, дата начала периода
+    :param p_end: datetime, дата окончания периода
+    :param windows: [(datetime, datetime)] or string, окна отчётов, см. get_full_log, обязательны:
+        звонки из лога всегда возвращаются по окнам
+    :param call_source: string, источник звонков: "log", "cdr" или "both"
+    :return: {string: object}, {'inc': вх_номера, 'out': исх_номера, 'log': звонки_по_окнам, 'cdr': звонки}
+    """
+    data = {'inc': get_at_inc_list(pbx), 'out': get_at_out_list(pbx), 'log': None, 'cdr': None}
+
+    if call_source in ('log', 'both'):
+        # Детализация звонков пишется по ходу разбора, если задан параметр detail_path
+        writer = get_detail_writer(pbx)
+
+        # Состояние разбора периодически сохраняется, если задан параметр snapshot_path
+        data['log'] = get_full_log(p_start, p_end, windows, writer, pbx, get_parse_state(pbx))
+
+        if writer:
+            writer.close()
+
+    if call_source in ('cdr', 'both'):
+        state_path, overlap = get_options('main', ['cdr_state', 'cdr_overlap'], True, default='')
+        root, ext = os.path.splitext(state_path or 'cdr_state.pickle')
+
+        data['cdr'] = get_cdr_log(p_start, p_end, '%s_%s%s' % (root, pbx, ext), pbx, data['out'],
+                                  int(overlap or 10800))
+
+    for result in list((data['log'] or {}).values()) + [data['cdr'] or {}]:
+        for value in result.values():
+            value['pbx'] = [pbx]
+
+    return data
+
+
+def get_pbx_list(pbx_list, p_start, p_end, windows, call_source='log'):
+    """
+    Загрузка настроек и звонков нескольких АТС, по процессу на АТС
+
+    :param pbx_list: [string], секции конфигурации АТС
+    :param p_start: datetime, дата начала периода
+    :param p_end: datetime, дата окончания периода
+    :param windows: [(datetime, datetime)] or string, окна отчётов, см. get_full_log
+    :param call_source: string, источник звонков: "log", "cdr" или "both"
+    :return: [{string: object}], данные каждой АТС в порядке pbx_list, см. get_pbx
+    """
+    if len(pbx_list) == 1:
+        return [get_pbx(pbx_list[0], p_start, p_end, windows, call_source)]
+
+    with ProcessPoolExecutor(len(pbx_list)) as pool:
+        return list(pool.map(get_pbx, pbx_list, repeat(p_start), repeat(p_end), repeat(windows), repeat(call_source)))
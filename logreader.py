@@ -0,0 +1,530 @@
+"""
+Модуль чтения подробного лога Астериска вместе с ротированными файлами.
+
+logrotate оставляет рядом с основным файлом "full" его старые копии: "full.1", "full.2.gz" ... "full.30.gz"
+(или ".xz"). get_log_set() находит все такие файлы, get_spans() упорядочивает их по времени, read_log() построчно
+отдаёт их содержимое как один непрерывный лог, пропуская файлы, целиком лежащие вне периода парсинга.
+read_log_from() дополнительно отдаёт позицию каждой строки и умеет продолжать чтение с сохранённой позиции.
+
+Первая и последняя метки времени каждого файла кэшируются (log_spans.json), чтобы не перечитывать
+неизменившиеся архивы при каждом запуске. Сжатые файлы распаковываются в фоновом потоке.
+
+read_blocks() читает не весь лог, а равномерно расположенные блоки - для быстрой оценки по выборке.
+"""
+import gzip
+import json
+import lzma
+import os
+import re
+import threading
+from datetime import datetime
+from queue import Queue
+
+from utils import log
+
+
+re_time = re.compile(r'^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\]')
+
+# Открытие файлов по расширению, файлы без расширения читаются как обычный текст
+openers = {
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+}
+
+CHUNK_SIZE = 1024 * 1024  # Размер блока распакованных данных, байт
+QUEUE_SIZE = 16  # Сколько блоков фоновый поток может распаковать заранее
+TAIL_SIZE = 64 * 1024  # Сколько байт с конца несжатого файла читать в поисках последней метки времени
+
+
+def get_log_set(full_path):
+    """
+    Поиск основного файла лога и его ротированных копий
+
+    :param full_path: string, путь к основному файлу лога
+    :return: [(int, string)], список (номер_ротации, путь), основной файл имеет номер 0
+    """
+    folder, name = os.path.split(full_path)
+    re_rotated = re.compile(r'^%s\.(\d+)(\.gz|\.xz)?$' % re.escape(name))
+
+    result = []
+
+    if os.path.isfile(full_path):
+        result.append((0, full_path))
+
+    try:
+        files = os.listdir(folder or '.')
+    except OSError as e:
+        log.error(e)
+        return result
+
+    for file in files:
+        rotated = re_rotated.match(file)
+
+        if rotated:
+            result.append((int(rotated.group(1)), os.path.join(folder, file)))
+
+    return result
+
+
+def _open_binary(path):
+    """
+    Открытие файла лога на чтение в двоичном режиме с распаковкой по расширению
+
+    :param path: string, путь к файлу
+    :return: file object
+    """
+    opener = openers.get(os.path.splitext(path)[1], open)
+
+    return opener(path, 'rb')
+
+
+def _read_chunks(path, queue, stop):
+    """
+    Фоновая распаковка файла блоками в очередь, окончание файла обозначается None
+
+    :param path: string, путь к сжатому файлу
+    :param queue: Queue, очередь блоков распакованных данных
+    :param stop: Event, сигнал прекратить распаковку, если строки больше не нужны
+    """
+    try:
+        with _open_binary(path) as f:
+            while not stop.is_set():
+                chunk = f.read(CHUNK_SIZE)
+
+                if not chunk:
+                    break
+
+                queue.put(chunk)
+    except (OSError, EOFError, lzma.LZMAError) as e:
+        log.error('Ошибка чтения файла %s: %s' % (path, e))
+    finally:
+        queue.put(None)
+
+
+def _iter_lines(path):
+    """
+    Построчное чтение файла лога, сжатые файлы распаковываются в фоновом потоке,
+    пока текущий поток разбирает уже распакованные строки
+
+    :param path: string, путь к файлу
+    :return: generator, строки файла
+    """
+    if os.path.splitext(path)[1] not in openers:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            yield from f
+
+        return
+
+    queue = Queue(QUEUE_SIZE)
+    stop = threading.Event()
+    thread = threading.Thread(target=_read_chunks, args=(path, queue, stop), daemon=True)
+    thread.start()
+
+    tail = b''
+    done = False
+
+    try:
+        while True:
+            chunk = queue.get()
+
+            if chunk is None:
+                done = True
+                break
+
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+
+            for line in lines:
+                yield line.decode('utf-8', 'replace') + '\n'
+
+        if tail:
+            yield tail.decode('utf-8', 'replace')
+    finally:
+        # Если чтение прервано, останавливаем фоновый поток и освобождаем очередь, чтобы он мог завершиться
+        stop.set()
+
+        while not done:
+            done = queue.get() is None
+
+
+def _get_time(line):
+    """
+    Метка времени строки лога
+
+    :param line: string, строка лога
+    :return: datetime or None
+    """
+    time_match = re_time.match(line)
+
+    if time_match:
+        return datetime.strptime(time_match.group(1), '%Y-%m-%d %H:%M:%S')
+
+
+def _get_span(path):
+    """
+    Первая и последняя метки времени файла лога и размер его данных
+
+    Для несжатого файла читается только его конец, сжатый приходится распаковать целиком.
+
+    :param path: string, путь к файлу
+    :return: (datetime, datetime, int) or None, если в файле нет строк с метками времени; размер - в байтах
+        распакованных данных, в тех же единицах, что смещения read_blocks
+    """
+    first = None
+    last = None
+    length = 0
+
+    if os.path.splitext(path)[1] not in openers:
+        with open(path, 'rb') as f:
+            for line in f:
+                first = _get_time(line.decode('utf-8', 'replace'))
+
+                if first:
+                    break
+
+            if not first:
+                return
+
+            f.seek(max(f.seek(0, os.SEEK_END) - TAIL_SIZE, 0))
+
+            for line in f:
+                last = _get_time(line.decode('utf-8', 'replace')) or last
+
+        if last:
+            return first, last, os.path.getsize(path)
+
+        first = None
+
+    for line in _iter_lines(path):
+        raw_time = _get_time(line)
+        length += len(line.encode('utf-8'))
+
+        if raw_time:
+            first = first or raw_time
+            last = raw_time
+
+    if first:
+        return first, last, length
+
+
+def _get_file_key(stat):
+    """
+    Ключ файла в кэше меток времени
+
+    logrotate переименовывает файлы при каждой ротации ("full.2.gz" становится "full.3.gz"), поэтому файл
+    определяется не путём, а номером inode, размером и временем изменения - они при переименовании не меняются.
+
+    :param stat: os.stat_result, сведения о файле
+    :return: string
+    """
+    return '%s:%s:%s' % (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def _load_span_cache(cache_path):
+    """
+    Загрузка кэша меток времени файлов
+
+    :param cache_path: string, путь к файлу кэша
+    :return: {string: {}}, {ключ_файла: {'path': string, 'span': [string, string] or None,
+        'length': int - размер распакованных данных}}, см. _get_file_key
+    """
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        log.error('Ошибка чтения кэша лога %s: %s' % (cache_path, e))
+
+    return {}
+
+
+def _save_span_cache(cache_path, cache):
+    """
+    Сохранение кэша меток времени файлов
+
+    :param cache_path: string, путь к файлу кэша
+    :param cache: {string: {}}, кэш
+    """
+    tmp = '%s.tmp' % cache_path
+
+    # Файл заменяется атомарно, читатель никогда не видит частично записанный кэш
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=1)
+
+        os.replace(tmp, cache_path)
+    except OSError as e:
+        log.error('Ошибка записи кэша лога %s: %s' % (cache_path, e))
+
+
+def get_spans(full_path, cache_path='log_spans.json'):
+    """
+    Список файлов лога, упорядоченный по времени, с первой и последней меткой времени каждого
+
+    Метки берутся из кэша, если файл не менялся, в том числе после переименования при ротации.
+    Записи удалённых файлов из кэша удаляются.
+
+    :param full_path: string, путь к основному файлу лога
+    :param cache_path: string, путь к файлу кэша меток времени
+    :return: [(string, datetime, datetime)], список (путь, начало, конец) от старых файлов к новым
+    """
+    cache = _load_span_cache(cache_path)
+    current = {}
+
+    result = []
+
+    for num, path in get_log_set(full_path):
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            log.error(e)
+            continue
+
+        key = _get_file_key(stat)
+        cached = cache.get(key)
+
+        if not cached:
+            span = _get_span(path)
+
+            cached = {
+                'span': [str(x) for x in span[:2]] if span else None,
+                'length': span[2] if span else stat.st_size
+            }
+
+        current[key] = dict(cached, path=os.path.abspath(path))
+
+        if cached['span']:
+            start, end = [datetime.strptime(x, '%Y-%m-%d %H:%M:%S') for x in cached['span']]
+
+            # Старые копии имеют больший номер ротации, им отдаётся приоритет при равных метках
+            result.append((start, -num, path, end))
+
+    if current != cache:
+        _save_span_cache(cache_path, current)
+
+    return [(path, start, end) for start, _, path, end in sorted(result)]
+
+
+def get_period_files(full_path, p_start=None, p_end=None, cache_path='log_spans.json'):
+    """
+    Файлы лога, содержащие строки периода, от старых к новым
+
+    :param full_path: string, путь к основному файлу лога
+    :param p_start: datetime, дата начала периода, по умолчанию без ограничения
+    :param p_end: datetime, дата окончания периода, по умолчанию без ограничения
+    :param cache_path: string, путь к файлу кэша меток времени
+    :return: [string], пути к файлам
+    """
+    return [path for path, start, end in get_spans(full_path, cache_path)
+            if not (p_start and end < p_start) and not (p_end and start > p_end)]
+
+
+def read_log(full_path, p_start=None, p_end=None, cache_path='log_spans.json'):
+    """
+    Построчное чтение основного файла лога и его ротированных копий как одного лога
+
+    Файлы читаются от старых к новым, поэтому звонки, начатые в одном файле и законченные
+    в следующем, приходят в парсер непрерывно. Файлы, целиком лежащие вне периода, пропускаются.
+
+    :param full_path: string, путь к основному файлу лога
+    :param p_start: datetime, дата начала периода, по умолчанию без ограничения
+    :param p_end: datetime, дата окончания периода, по умолчанию без ограничения
+    :param cache_path: string, путь к файлу кэша меток времени
+    :return: generator, строки лога
+    """
+    for path in get_period_files(full_path, p_start, p_end, cache_path):
+        yield from _iter_lines(path)
+
+
+def read_log_from(full_path, p_start=None, p_end=None, position=None, cache_path='log_spans.json'):
+    """
+    Построчное чтение лога, как read_log, с позицией после каждой строки для продолжения чтения
+
+    Файл в позиции задаётся своей первой меткой времени, а не именем: после ротации "full" становится
+    "full.1", затем "full.2.gz", но первая метка и смещение в распакованных данных не меняются.
+
+    :param full_path: string, путь к основному файлу лога
+    :param p_start: datetime, дата начала периода, по умолчанию без ограничения
+    :param p_end: datetime, дата окончания периода, по умолчанию без ограничения
+    :param position: (string, int), позиция, с которой продолжить чтение, по умолчанию с начала
+    :param cache_path: string, путь к файлу кэша меток времени
+    :return: generator, ((первая_метка_файла, смещение_после_строки), строка)
+    """
+    for path, start, end in get_spans(full_path, cache_path):
+        if (p_start and end < p_start) or (p_end and start > p_end):
+            continue
+
+        key = str(start)
+        offset = 0
+
+        if position:
+            if key < position[0]:
+                continue
+
+            if key == position[0]:
+                offset = position[1]
+
+        if os.path.splitext(path)[1] not in openers:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+
+                for line in f:
+                    offset += len(line)
+
+                    yield (key, offset), line.decode('utf-8', 'replace')
+
+            continue
+
+        for line_offset, line in _iter_offsets(path):
+            if line_offset < offset:
+                continue
+
+            yield (key, line_offset + len(line.encode('utf-8'))), line
+
+
+def _iter_offsets(path, offset=0):
+    """
+    Построчное чтение файла лога со смещением начала каждой строки в распакованных данных
+
+    :param path: string, путь к файлу
+    :param offset: int, смещение начала файла
+    :return: generator, (смещение, строка)
+    """
+    for line in _iter_lines(path):
+        yield offset, line
+        offset += len(line.encode('utf-8'))
+
+
+def _read_plain_block(f, pos, block_size):
+    """
+    Чтение блока несжатого файла: строки, начинающиеся в диапазоне [pos, pos + block_size)
+
+    :param f: file object, файл, открытый в двоичном режиме
+    :param pos: int, начало блока
+    :param block_size: int, размер блока, байт
+    :return: [string], строки блока
+    """
+    # Строка, начатая до блока, ему не принадлежит: дочитываем строку, содержащую байт перед блоком
+    if pos:
+        f.seek(pos - 1)
+        f.readline()
+    else:
+        f.seek(0)
+
+    lines = []
+
+    while f.tell() < pos + block_size:
+        line = f.readline()
+
+        if not line:
+            break
+
+        lines.append(line.decode('utf-8', 'replace'))
+
+    return lines
+
+
+def get_log_length(paths, cache_path='log_spans.json'):
+    """
+    Общий размер распакованных данных файлов лога - длина сетки блоков read_blocks
+
+    Сжатые файлы учитываются по размеру распакованных данных из кэша меток времени (см. get_spans),
+    а не по размеру на диске.
+
+    :param paths: [string], файлы лога, см. get_period_files
+    :param cache_path: string, путь к файлу кэша меток времени
+    :return: int, байт
+    """
+    cache = _load_span_cache(cache_path)
+    total = 0
+
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            log.error(e)
+            continue
+
+        cached = cache.get(_get_file_key(stat))
+        total += cached['length'] if cached else stat.st_size
+
+    return total
+
+
+def get_block_step(length, blocks, block_size):
+    """
+    Шаг между началами блоков выборки, см. read_blocks
+
+    :param length: int, размер распакованных данных лога, см. get_log_length
+    :param blocks: int, желаемое количество блоков
+    :param block_size: int, размер блока, байт
+    :return: int, шаг, байт, не меньше block_size
+    """
+    return max(block_size, length // max(blocks, 1))
+
+
+def read_blocks(paths, step, block_size):
+    """
+    Выборочное чтение лога блоками размером block_size, начинающимися через каждые step байт
+
+    Сетка блоков одна на весь набор файлов: смещения отсчитываются в распакованных данных файлов,
+    взятых подряд, так что ротация лога не сдвигает блоки и не меняет долю выборки. Блок на стыке
+    файлов возвращается целиком. Несжатые файлы читаются позиционированием, сжатые распаковываются
+    потоком, но возвращаются только строки блоков. Строка относится к блоку, в котором она начинается.
+
+    :param paths: [string], файлы лога, см. get_period_files
+    :param step: int, шаг между началами блоков, см. get_block_step
+    :param block_size: int, размер блока, байт
+    :return: generator, [string] - строки каждого блока
+    """
+    base = 0
+    block = None
+    lines = []
+
+    for path in paths:
+        if os.path.splitext(path)[1] not in openers:
+            size = os.path.getsize(path)
+            index = base // step
+
+            # Блок ячейки, в которую попало начало файла, может закончиться раньше
+            if index * step + block_size <= base:
+                index += 1
+
+            with open(path, 'rb') as f:
+                while index * step < base + size:
+                    pos = max(index * step - base, 0)
+                    block_lines = _read_plain_block(f, pos, index * step + block_size - base - pos)
+
+                    if index != block:
+                        if lines:
+                            yield lines
+
+                        block = index
+                        lines = []
+
+                    lines.extend(block_lines)
+                    index += 1
+
+            base += size
+            continue
+
+        offset, line = base, ''
+
+        for offset, line in _iter_offsets(path, base):
+            if offset % step >= block_size:
+                continue
+
+            if offset // step != block:
+                if lines:
+                    yield lines
+
+                block = offset // step
+                lines = []
+
+            lines.append(line)
+
+        base = offset + len(line.encode('utf-8'))
+
+    if lines:
+        yield lines
@@ -0,0 +1,124 @@
+"""
+Модуль нормализации городских номеров.
+
+Номер приводится к местному виду "XXX-XX-XX" (7 цифр), "XX-XX-XX" (6) или "X-XX-XX" (5).
+Коды стран и городов из параметров country_codes и area_codes секции main собираются в префиксное
+дерево, поэтому номер любой длины разбирается одним проходом по цифрам: самый длинный известный
+префикс отрезается, остаток считается местным номером. Номер без известного префикса, как и раньше,
+сокращается до последних 7 цифр.
+
+Результаты кэшируются (normalize_num), одни и те же номера в логе разбираются один раз.
+"""
+import re
+from functools import lru_cache
+
+from utils import get_options
+
+
+re_digit = re.compile(r'\D')
+
+CACHE_SIZE = 65536  # Количество кэшируемых номеров
+LOCAL_LENGTHS = (5, 6, 7)  # Допустимые длины местного номера
+
+
+class PrefixTrie:
+
+    def __init__(self, prefixes=()):
+        """
+        Префиксное дерево кодов номеров
+
+        :param prefixes: [string], префиксы из цифр
+        """
+        self.root = {}
+
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        """
+        Добавление префикса
+
+        :param prefix: string, префикс из цифр
+        """
+        node = self.root
+
+        for digit in prefix:
+            node = node.setdefault(digit, {})
+
+        node[None] = True
+
+    def match(self, digits):
+        """
+        Длины всех известных префиксов номера, от длинных к коротким
+
+        :param digits: string, номер из цифр
+        :return: [int]
+        """
+        result = []
+        node = self.root
+
+        for pos, digit in enumerate(digits):
+            node = node.get(digit)
+
+            if node is None:
+                break
+
+            if None in node:
+                result.append(pos + 1)
+
+        return result[::-1]
+
+
+_trie = None
+
+
+def get_trie():
+    """
+    Дерево префиксов из параметров конфигурации: коды городов с кодами стран и без них
+
+    :return: PrefixTrie
+    """
+    global _trie
+
+    if _trie is None:
+        country_codes, area_codes = get_options('main', ['country_codes', 'area_codes'], True, default='') or ['', '']
+
+        countries = [''] + [x.strip() for x in country_codes.split(',') if x.strip()]
+        areas = [x.strip() for x in area_codes.split(',') if x.strip()]
+
+        _trie = PrefixTrie(c + a for c in countries for a in areas)
+
+    return _trie
+
+
+def format_local(local):
+    """
+    Форматирование местного номера
+
+    :param local: string, номер из 5-7 цифр
+    :return: string, "XXX-XX-XX", "XX-XX-XX" или "X-XX-XX"
+    """
+    return '%s-%s-%s' % (local[:-4], local[-4:-2], local[-2:])
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize_num(num):
+    """
+    Нормализация городского номера
+
+    :param num: string, "сырой" номер, нецифровые символы игнорируются
+    :return: string, местный номер, см. format_local, или пустая строка, если номер слишком короткий
+    """
+    digits = re_digit.sub('', num)
+
+    for length in get_trie().match(digits):
+        if len(digits) - length in LOCAL_LENGTHS:
+            return format_local(digits[length:])
+
+    if len(digits) >= 7:
+        return format_local(digits[-7:])
+
+    if len(digits) in LOCAL_LENGTHS:
+        return format_local(digits)
+
+    return ''
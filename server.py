@@ -0,0 +1,295 @@
+"""
+HTTP-сервис запросов к статистике звонков.
+
+Статистика загружается один раз (подробный лог всех АТС, окна по дням) и индексируется
+по гор. номеру, вн. номеру и дате, поэтому ответ на запрос - сумма по нескольким дням из памяти,
+без повторного разбора лога. Ответы кэшируются, кэш сбрасывается при загрузке новых данных:
+фоновый поток раз в reload_interval секунд проверяет файлы лога и дочитывает изменившиеся сутки.
+
+Запросы (даты в формате YYYY-MM-DD, from и to включительно, по умолчанию - весь загруженный период):
+
+    GET /number/123-45-67?from=2017-01-01&to=2017-01-31
+    GET /extension/1001?from=2017-01-01&to=2017-01-31
+    GET /numbers
+    POST /reload
+
+Параметры секции server: host, port, start_date, reload_interval. Запуск: python server.py
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import importer
+import utils
+from logreader import get_log_set
+from utils import log, get_options
+
+
+CACHE_SIZE = 1024  # Количество кэшируемых ответов
+
+
+def _sum_stat(total, stat):
+    """
+    Добавление сумм статистики к итогу
+
+    :param total: {string: int}, итог
+    :param stat: {string: object}, статистика, см. importer.new_stat
+    """
+    for key in importer.STAT_KEYS:
+        total[key] = total.get(key, 0) + stat[key]
+
+
+class CallIndex:
+
+    def __init__(self, pbx_list, p_start):
+        """
+        Индекс статистики звонков по гор. номеру, вн. номеру и дате
+
+        :param pbx_list: [string], секции конфигурации АТС
+        :param p_start: datetime, дата начала загружаемого периода
+        """
+        self.pbx_list = pbx_list
+        self.p_start = p_start
+        self.p_last = p_start  # Начало суток, с которых начинается дозагрузка, см. ingest
+
+        self.numbers = {}  # {гор_номер: {дата: {'inc': статистика, 'out': статистика}}}
+        self.extensions = {}  # {вн_номер: {дата: {направление: {гор_номер: статистика}}}}
+        self.files = None
+
+        self.lock = threading.Lock()
+        self.ingest_lock = threading.Lock()  # Дозагрузки из фонового потока и POST /reload не идут одновременно
+        self.cache = OrderedDict()
+
+    def _get_files(self):
+        """
+        Размер и время изменения файлов лога всех АТС, по ним определяется появление новых данных
+
+        :return: [(string, int, float)]
+        """
+        files = []
+
+        for pbx in self.pbx_list:
+            for _, path in get_log_set(importer.get_log_path(pbx) or ''):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                files.append((path, stat.st_size, stat.st_mtime))
+
+        return sorted(files)
+
+    def ingest(self):
+        """
+        Загрузка статистики с начала последних загруженных суток, если файлы лога изменились
+
+        Лог каждой АТС разбирается напрямую через importer.get_full_log, без БД АТС, выгрузки детализации
+        и снимков разбора: они принадлежат пакетному запуску и не должны изменяться сервисом.
+
+        Звонки, ещё идущие во время загрузки, не учитываются (их длительность неизвестна), следующая загрузка
+        начинается с суток самого раннего из них и учитывает их целиком.
+
+        :return: bool, True - если данные загружены
+        """
+        with self.ingest_lock:
+            return self._ingest()
+
+    def _ingest(self):
+        """
+        Загрузка статистики, см. ingest
+
+        :return: bool, True - если данные загружены
+        """
+        files = self._get_files()
+
+        if files == self.files:
+            return False
+
+        p_start = self.p_last
+        p_end = datetime.now()
+
+        days = {}
+        open_calls = {}
+
+        for pbx in self.pbx_list:
+            pbx_log = importer.get_full_log(p_start, p_end, 'day', detail=None, pbx=pbx, state=None,
+                                            finish_open=False, open_calls=open_calls)
+
+            for (w_start, _), result in pbx_log.items():
+                importer.merge_result(days.setdefault(w_start.date(), {}), result)
+
+        with self.lock:
+            for day, result in days.items():
+                for cm, value in result.items():
+                    self.numbers.setdefault(cm, {})[day] = value
+
+                    for direction in ['inc', 'out']:
+                        for user, stat in value[direction]['users'].items():
+                            user_days = self.extensions.setdefault(user, {})
+                            user_days.setdefault(day, {'inc': {}, 'out': {}})[direction][cm] = stat
+
+            self.files = files
+
+            # Сутки звонков, открытых к концу лога, будут перечитаны целиком
+            p_last = min([p_end] + list(open_calls.values()))
+            self.p_last = datetime(p_last.year, p_last.month, p_last.day)
+            self.cache.clear()
+
+        log.info('Загружена статистика звонков с %s' % p_start)
+
+        return True
+
+    def query(self, path, params):
+        """
+        Ответ на запрос из кэша или из индекса
+
+        :param path: string, путь запроса
+        :param params: {string: [string]}, параметры запроса
+        :return: (int, object), HTTP-код и тело ответа
+        """
+        key = (path, tuple(sorted((k, tuple(v)) for k, v in params.items())))
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+            response = self._query(path, params)
+
+            self.cache[key] = response
+
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+        return response
+
+    def _query(self, path, params):
+        """
+        Выполнение запроса по индексу
+
+        :param path: string, путь запроса
+        :param params: {string: [string]}, параметры запроса
+        :return: (int, object), HTTP-код и тело ответа
+        """
+        try:
+            d_from = datetime.strptime(params['from'][0], '%Y-%m-%d').date() if 'from' in params else None
+            d_to = datetime.strptime(params['to'][0], '%Y-%m-%d').date() if 'to' in params else None
+        except ValueError:
+            return 400, {'error': 'Неверный формат даты, ожидается YYYY-MM-DD'}
+
+        parts = [unquote(x) for x in path.strip('/').split('/')]
+
+        if parts == ['numbers']:
+            return 200, sorted(self.numbers)
+
+        if len(parts) != 2 or parts[0] not in ('number', 'extension'):
+            return 404, {'error': 'Неизвестный запрос'}
+
+        kind, key = parts
+        index = self.numbers if kind == 'number' else self.extensions
+
+        response = {kind: key, 'from': str(d_from or ''), 'to': str(d_to or ''), 'inc': {}, 'out': {}}
+
+        for day, value in index.get(key, {}).items():
+            if (d_from and day < d_from) or (d_to and day > d_to):
+                continue
+
+            for direction in ['inc', 'out']:
+                if kind == 'number':
+                    _sum_stat(response[direction], value[direction])
+                    continue
+
+                for cm, stat in value[direction].items():
+                    _sum_stat(response[direction], stat)
+                    _sum_stat(response[direction].setdefault('numbers', {}).setdefault(cm, {}), stat)
+
+        return 200, response
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def _send(self, code, body):
+        """
+        Отправка ответа в JSON
+
+        :param code: int, HTTP-код
+        :param body: object, тело ответа
+        """
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+
+        self._send(*self.server.index.query(url.path, parse_qs(url.query)))
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/reload':
+            self._send(404, {'error': 'Неизвестный запрос'})
+            return
+
+        self._send(200, {'reloaded': self.server.index.ingest()})
+
+    def log_message(self, format, *args):
+        log.info('%s %s' % (self.address_string(), format % args))
+
+
+def _watch(index, interval):
+    """
+    Фоновая дозагрузка статистики при изменении файлов лога
+
+    :param index: CallIndex, индекс
+    :param interval: int, период проверки, секунд
+    """
+    while True:
+        time.sleep(interval)
+
+        try:
+            index.ingest()
+        except Exception as e:
+            log.error('Ошибка дозагрузки статистики: %s' % e)
+
+
+def serve():
+    """
+    Загрузка статистики и запуск HTTP-сервиса
+
+    """
+    host, port, start_date, interval = get_options('server', ['host', 'port', 'start_date', 'reload_interval'],
+                                                   True, default='')
+
+    p_start = datetime.strptime(start_date, '%Y-%m-%d') if start_date else datetime.now() - timedelta(days=31)
+
+    index = CallIndex(utils.get_pbx_list(), p_start)
+    index.ingest()
+
+    threading.Thread(target=_watch, args=(index, int(interval or 300)), daemon=True).start()
+
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port or 8080)), QueryHandler)
+    server.index = index
+
+    log.info('HTTP-сервис запущен на %s:%s' % server.server_address)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    serve()
@@ -0,0 +1,141 @@
+"""
+Модуль содержит потоковый скетч квантилей KLL.
+
+KLLSketch хранит не все значения, а ограниченную выборку с весами, поэтому память на один скетч
+не зависит от числа звонков (порядка 3 * k значений). Скетчи, собранные на разных частях лога
+или за разные дни, объединяются методом merge без потери точности относительно одного большого скетча.
+
+Сжатие уровней детерминированное (смещение чередуется), одинаковые входные данные всегда дают
+одинаковый скетч.
+"""
+import math
+
+
+class KLLSketch:
+
+    def __init__(self, k=200, c=2 / 3):
+        """
+        Скетч квантилей KLL (Karnin, Lang, Liberty)
+
+        :param k: int, размер верхнего уровня, определяет точность: ошибка ранга порядка 1.7 / k
+        :param c: float, коэффициент уменьшения размера нижних уровней
+        """
+        self.k = k
+        self.c = c
+        self.count = 0
+        self.size = 0
+        self.max_size = 0
+        self.compactors = []
+        self.offset = 0
+
+        self._grow()
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        return isinstance(other, KLLSketch) and self.count == other.count and self.compactors == other.compactors
+
+    def _capacity(self, height):
+        """
+        Вместимость уровня, верхний уровень вмещает k значений, каждый ниже в 1 / c раз меньше
+
+        :param height: int, номер уровня, 0 - нижний
+        :return: int
+        """
+        depth = len(self.compactors) - height - 1
+
+        return int(math.ceil(self.k * self.c ** depth)) + 1
+
+    def _grow(self):
+        """
+        Добавление нового верхнего уровня
+
+        """
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _compress(self):
+        """
+        Сжатие нижнего переполненного уровня: половина отсортированных значений с удвоенным весом
+        переходит на уровень выше
+
+        """
+        for height, items in enumerate(self.compactors):
+            if len(items) >= self._capacity(height):
+                if height + 1 == len(self.compactors):
+                    self._grow()
+
+                items.sort()
+
+                # При нечётном количестве одно значение остаётся на уровне
+                rest = [items.pop()] if len(items) % 2 else []
+
+                self.compactors[height + 1].extend(items[self.offset::2])
+                self.compactors[height] = rest
+                self.offset = 1 - self.offset
+
+                break
+
+        self.size = sum(len(x) for x in self.compactors)
+
+    def update(self, value):
+        """
+        Добавление значения
+
+        :param value: int or float, значение
+        """
+        self.compactors[0].append(value)
+        self.count += 1
+        self.size += 1
+
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Объединение со скетчем other, other не изменяется
+
+        :param other: KLLSketch, скетч
+        :return: KLLSketch, self
+        """
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+
+        for height, items in enumerate(other.compactors):
+            self.compactors[height].extend(items)
+
+        self.count += other.count
+        self.size = sum(len(x) for x in self.compactors)
+
+        while self.size >= self.max_size:
+            self._compress()
+
+        return self
+
+    def quantiles(self, qs):
+        """
+        Оценка квантилей
+
+        :param qs: [float], квантили от 0 до 1
+        :return: [int or float or None], значения квантилей, None - если скетч пуст
+        """
+        weighted = sorted((x, 2 ** h) for h, items in enumerate(self.compactors) for x in items)
+        total = sum(w for _, w in weighted)
+
+        result = []
+
+        for q in qs:
+            value = None
+            cum = 0
+
+            for x, w in weighted:
+                value = x
+                cum += w
+
+                if cum >= q * total:
+                    break
+
+            result.append(value)
+
+        return result
@@ -0,0 +1,237 @@
+"""
+Модуль сохранения состояния разбора подробного лога.
+
+ParseState периодически (каждые snapshot_lines строк) записывает в файл SQLite позицию в логе,
+открытые звонки и накопленную статистику. Если разбор прерван (нехватка памяти, таймаут cron),
+следующий запуск с теми же параметрами продолжает с последнего снимка, а не с первой строки.
+
+Открытые звонки сверх open_calls_limit вытесняются на диск в тот же файл (OpenCalls) и читаются
+обратно при появлении их строк. Все изменения файла между снимками идут в одной транзакции,
+поэтому после сбоя файл всегда соответствует последнему снимку.
+"""
+import pickle
+import sqlite3
+
+from utils import log, get_options
+
+
+class OpenCalls(dict):
+
+    def __init__(self, db, limit):
+        """
+        Словарь открытых звонков {id: данные} с вытеснением старых звонков на диск. Заменяет
+        defaultdict(dict) в разборе лога: отсутствующий звонок создаётся пустым, вытесненный - читается с диска.
+
+        :param db: Connection, соединение SQLite с таблицей open_calls
+        :param limit: int, сколько открытых звонков держать в памяти
+        """
+        super().__init__()
+
+        self.db = db
+        self.limit = limit
+        self.spilled = set()
+
+    def __contains__(self, raw_id):
+        return dict.__contains__(self, raw_id) or raw_id in self.spilled
+
+    def __iter__(self):
+        return iter(list(dict.keys(self)) + sorted(self.spilled))
+
+    def __missing__(self, raw_id):
+        value = self._load(raw_id) if raw_id in self.spilled else {}
+
+        dict.__setitem__(self, raw_id, value)
+
+        if dict.__len__(self) > self.limit:
+            self._spill(raw_id)
+
+        return value
+
+    def pop(self, raw_id, *default):
+        if not dict.__contains__(self, raw_id) and raw_id in self.spilled:
+            return self._load(raw_id)
+
+        return dict.pop(self, raw_id, *default)
+
+    def _load(self, raw_id):
+        """
+        Чтение вытесненного звонка с диска
+
+        :param raw_id: string, идентификатор звонка
+        :return: {string: object}, данные звонка
+        """
+        row = self.db.execute('SELECT value FROM open_calls WHERE raw_id = ?', (raw_id,)).fetchone()
+        self.db.execute('DELETE FROM open_calls WHERE raw_id = ?', (raw_id,))
+        self.spilled.discard(raw_id)
+
+        return pickle.loads(row[0])
+
+    def _spill(self, current):
+        """
+        Вытеснение на диск старшей половины открытых звонков
+
+        :param current: string, идентификатор звонка, который сейчас разбирается, не вытесняется
+        """
+        items = sorted((value['start'], raw_id) for raw_id, value in dict.items(self)
+                       if raw_id != current and 'start' in value)
+
+        spill = [raw_id for _, raw_id in items[:len(items) // 2]]
+
+        self.db.executemany('INSERT OR REPLACE INTO open_calls (raw_id, value) VALUES (?, ?)',
+                            [(raw_id, pickle.dumps(dict.pop(self, raw_id))) for raw_id in spill])
+        self.spilled.update(spill)
+
+
+class ParseState:
+
+    def __init__(self, path, interval=100000, limit=100000):
+        """
+        Снимки состояния разбора лога в файле SQLite
+
+        :param path: string, путь к файлу снимков
+        :param interval: int, через сколько строк лога делать снимок
+        :param limit: int, сколько открытых звонков держать в памяти, см. OpenCalls
+        """
+        self.path = path
+        self.interval = interval
+        self.lines = 0
+        self.position = None
+        self.key = None
+        self.closed = set()
+        self.day = None
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS snapshot (key TEXT PRIMARY KEY, value BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS open_calls (raw_id TEXT PRIMARY KEY, value BLOB)')
+        self.db.commit()
+
+        self.raw = OpenCalls(self.db, limit)
+
+    def load(self, key):
+        """
+        Загрузка последнего снимка, если он сделан для разбора с тем же ключом, иначе файл очищается
+
+        :param key: string, ключ разбора, не меняющийся между запусками (начало периода, АТС)
+        :return: {string: object} or None, снимок: results, parts (позиция, открытые и завершённые звонки
+            восстанавливаются в атрибуты объекта)
+        """
+        self.key = key
+
+        row = self.db.execute("SELECT value FROM snapshot WHERE key = 'state'").fetchone()
+        state = pickle.loads(row[0]) if row else None
+
+        if not state or state['key'] != key:
+            self.reset()
+
+            return
+
+        dict.update(self.raw, state['memory'])
+        self.raw.spilled = state['spilled']
+        self.position = state['position']
+        self.closed = state['closed']
+        self.day = state['day']
+
+        return state
+
+    def reset(self):
+        """
+        Отказ от снимка: файл очищается, разбор начинается с начала лога
+
+        """
+        self.db.execute('DELETE FROM snapshot')
+        self.db.execute('DELETE FROM open_calls')
+        self.db.commit()
+
+        dict.clear(self.raw)
+        self.raw.spilled = set()
+        self.position = None
+        self.closed = set()
+        self.day = None
+
+    def track(self, lines):
+        """
+        Обёртка строк лога, запоминающая позицию после полностью разобранной строки
+
+        Позиция строки сохраняется, когда разбор запрашивает следующую строку.
+
+        :param lines: iterable, (позиция, строка), см. logreader.read_log_from
+        :return: generator, строки
+        """
+        for position, line in lines:
+            yield line
+
+            self.position = position
+
+    def tick(self):
+        """
+        Счётчик строк, True - пора делать снимок
+
+        :return: bool
+        """
+        self.lines += 1
+
+        return self.lines % self.interval == 0
+
+    def save(self, closed, day, time, results, detail=None):
+        """
+        Запись снимка и фиксация транзакции вместе с вытесненными звонками
+
+        :param closed: {string}, идентификаторы завершённых звонков
+        :param day: date, текущие сутки разбора
+        :param time: datetime, время последней разобранной строки, все звонки снимка начались не позже
+        :param results: {} or {(datetime, datetime): {}}, накопленная статистика
+        :param detail: CallDetailWriter, выгрузка детализации, перед снимком сбрасывается на диск
+        """
+        parts = None
+
+        if detail:
+            detail.flush()
+            parts = detail.parts
+
+        state = {
+            'key': self.key,
+            'position': self.position,
+            'closed': closed,
+            'day': day,
+            'time': time,
+            'results': results,
+            'parts': parts,
+            'memory': dict(dict.items(self.raw)),
+            'spilled': self.raw.spilled
+        }
+
+        self.db.execute("INSERT OR REPLACE INTO snapshot (key, value) VALUES ('state', ?)",
+                        (pickle.dumps(state, pickle.HIGHEST_PROTOCOL),))
+        self.db.commit()
+
+    def close(self):
+        """
+        Завершение разбора: снимки больше не нужны, файл очищается
+
+        """
+        self.db.execute('DELETE FROM snapshot')
+        self.db.execute('DELETE FROM open_calls')
+        self.db.commit()
+        self.db.close()
+
+
+def get_parse_state(pbx=None):
+    """
+    Создание снимков разбора по параметрам snapshot_path, snapshot_lines и open_calls_limit секции main
+
+    :param pbx: string, имя АТС, добавляется к имени файла снимков
+    :return: ParseState or None, если снимки не настроены
+    """
+    path, interval, limit = get_options('main', ['snapshot_path', 'snapshot_lines', 'open_calls_limit'], True,
+                                        default='')
+
+    if not path:
+        return
+
+    if pbx:
+        path = '%s.%s' % (path, pbx)
+
+    try:
+        return ParseState(path, int(interval or 100000), int(limit or 100000))
+    except (sqlite3.Error, ValueError) as e:
+        log.error('Ошибка открытия файла снимков %s: %s' % (path, e))
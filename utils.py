@@ -5,6 +5,7 @@ log - интерфейс логгирования, если необходимы
 cfg - интерфейс считывания конфигурационного файла
 get_options() - функция считывания параметров конфигурации
 get_city() - получает список городских для внутренних номеров
+get_pbx_list() - список секций конфигурации АТС
 """
 import configparser
 import logging
@@ -34,7 +35,7 @@ def _init_config(conf_file):
     return True
 
 
-def get_options(section, options=None, ignore_default=False, conf_file='config.ini'):
+def get_options(section, options=None, ignore_default=False, conf_file='config.ini', default=None):
     """
     Считывает параметры из конфигурационного файла
 
@@ -44,6 +45,7 @@ def get_options(section, options=None, ignore_default=False, conf_file='config.i
     :param options: [string], параметры для считывания, по умолчанию содержит ['host', 'user', 'password']
     :param ignore_default: bool, игнорировать список опций по умолчанию для options
     :param conf_file: string, имя файла конфигурации
+    :param default: string, значение отсутствующих параметров, по умолчанию отсутствие параметра считается ошибкой
     :return: [string] or string, считанные параметры или None в случае ошибки чтения любого из параметров
     """
     if not cfg:
@@ -60,6 +62,10 @@ def get_options(section, options=None, ignore_default=False, conf_file='config.i
         options_list += options
 
     for option in options_list:
+        if default is not None and not cfg.has_option(section, option):
+            result_list.append(default)
+            continue
+
         try:
             result_list.append(cfg.get(section, option))
         except configparser.NoSectionError as e:
@@ -76,6 +82,17 @@ def get_options(section, options=None, ignore_default=False, conf_file='config.i
         return result_list
 
 
+def get_pbx_list():
+    """
+    Список секций конфигурации АТС из параметра pbx_list секции main, перечисленных через запятую
+
+    :return: [string], по умолчанию ['asterisk']
+    """
+    pbx_list = get_options('main', 'pbx_list', True, default='asterisk') or ''
+
+    return [x.strip() for x in pbx_list.split(',') if x.strip()]
+
+
 def get_city(num, at_list):
     """
     Получает список городских для внутренних номеров, вн. номеров может быть несколько, разделенных запятой